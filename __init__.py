@@ -1,5 +1,5 @@
 import server
-from .api import add_api_routes
+from .api import add_api_routes, load_compiled_nodes
 
 # On importe la classe de notre nouveau nœud depuis son fichier
 from .compiler_node import SubgraphCompiler
@@ -7,6 +7,9 @@ from .compiler_node import SubgraphCompiler
 # Le serveur est prêt, on ajoute les routes
 add_api_routes(server.PromptServer.instance.app)
 
+# Les nœuds compilés installés à chaud sont rechargés à chaque démarrage
+load_compiled_nodes()
+
 # On déclare à ComfyUI le nom de la classe et le nom à afficher dans le menu
 NODE_CLASS_MAPPINGS = {
     "SubgraphCompiler": SubgraphCompiler
@@ -4,18 +4,28 @@ import inspect
 import re
 import os
 import ast
-from nodes import NODE_CLASS_MAPPINGS
+from nodes import NODE_CLASS_MAPPINGS, NODE_DISPLAY_NAME_MAPPINGS
 import folder_paths
 import types
 import json
 import sys
 import traceback
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 import builtins
 import importlib.util
 import graphlib
 import pprint
 import warnings
+import threading
+import asyncio
+import hashlib
+import gzip
+import copy
+import symtable
+import time
+import sqlite3
+import secrets
+import tempfile
 # ===============================================================
 # --- CONSTANTES DE CONFIGURATION ---
 # ===============================================================
@@ -28,6 +38,24 @@ EXTERNAL_MODULES = {
 UNIX_ONLY_MODULES = {'fcntl', 'grp', 'pwd', 'resource', 'termios'}
 LEGACY_PY2_MODULES = {'StringIO', 'cStringIO', 'dummy_threading'}
 IGNORE_IMPORTS = {'brotli', 'brotlicffi', 'amdsmi', 'io', 'mediapipe'}
+GENERATED_FILE_HEADER = "# ---Don't use this file for build_indexes---"
+# Dossier où l'endpoint d'installation écrit les nœuds compilés
+COMPILED_NODES_DIR = os.environ.get(
+    "SUBGRAPH_COMPILER_OUTPUT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiled_nodes")
+)
+# Index partagé entre les processus ComfyUI d'une même machine (un par GPU)
+INDEX_STORE_PATH = os.environ.get(
+    "SUBGRAPH_COMPILER_INDEX_PATH",
+    os.path.join(COMPILED_NODES_DIR, "index.sqlite3")
+)
+# Budget de résolution par défaut (None = illimité), surchargeable par requête via "budget"
+RESOLUTION_BUDGET = {
+    'max_symbols': 1000,   # définitions intégrées
+    'max_files': 300,      # fichiers sources ouverts
+    'max_depth': 25,       # distance depuis les nœuds du subgraph
+    'max_seconds': 60.0,   # durée de la résolution
+}
 IGNORE_DEFINITIONS = {
     'cached_func',
     'attention_bleh',
@@ -36,158 +64,519 @@ IGNORE_DEFINITIONS = {
     'apply_rotary_emb'
 }
 
+# ===============================================================
+# --- SUIVI DE PROGRESSION ET ANNULATION ---
+# ===============================================================
+PROGRESS_EVENT = "subgraph_compiler_progress"
+ACTIVE_COMPILES = {}
+
+class CompileCancelled(Exception):
+    """Levée quand le client annule une compilation en cours."""
+
+class CompileProgress:
+    """
+    Envoie l'avancement d'une compilation au client via le websocket de PromptServer
+    et porte le drapeau d'annulation, vérifié à chaque étape.
+    """
+    def __init__(self, compile_id=None, client_id=None):
+        self.compile_id = compile_id
+        self.client_id = client_id
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def emit(self, stage, **data):
+        # Sans clientId, send_sync diffuserait à tous les clients connectés (code généré compris)
+        if self.compile_id is None or self.client_id is None:
+            return
+        payload = {"compile_id": self.compile_id, "stage": stage, **data}
+        server.PromptServer.instance.send_sync(PROGRESS_EVENT, payload, self.client_id)
+
+    def update(self, stage, **data):
+        if self.cancel_event.is_set():
+            raise CompileCancelled(f"Compilation '{self.compile_id}' annulée.")
+        self.emit(stage, **data)
+
 # ===============================================================
 # --- INDEXEUR DE CLASSES ---
 # ===============================================================
+INDEX_STORE = None
 CLASS_INDEX = None
 FUNCTION_INDEX = None
+# Les compilations tournent dans des threads : un seul construit les index
+INDEX_LOCK = threading.Lock()
+INDEX_SCHEMA_VERSION = 1
+# Préfixe des modules des nœuds compilés installés à chaud
+COMPILED_MODULE_PREFIX = "subgraph_compiled."
 
-def build_indexes():
-    global CLASS_INDEX, FUNCTION_INDEX
-    if CLASS_INDEX is not None and FUNCTION_INDEX is not None:
-        return
+class InterProcessLock:
+    """
+    Verrou exclusif sur un fichier, partagé entre processus (fcntl sous Unix,
+    msvcrt sous Windows). Le système le libère si le processus meurt.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.handle = open(self.path, 'a+b')
+        if os.name == 'nt':
+            import msvcrt
+            self.handle.seek(0)
+            while True:
+                try:
+                    # LK_LOCK abandonne après ~10 s : on réessaie jusqu'à l'obtenir
+                    msvcrt.locking(self.handle.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        else:
+            import fcntl
+            fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX)
+        return self
 
-    print("--- Subgraph Compiler: Building final indexes... ---")
-    CLASS_INDEX = {}
-    FUNCTION_INDEX = {}
-    
-    for class_name, class_obj in NODE_CLASS_MAPPINGS.items():
-        if hasattr(class_obj, '__module__'):
-            CLASS_INDEX[class_name] = class_obj.__module__
+    def __exit__(self, *exc_info):
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self.handle.seek(0)
+                msvcrt.locking(self.handle.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+        finally:
+            self.handle.close()
+            self.handle = None
 
+class IndexStore:
+    """
+    Index des classes et fonctions stocké dans une base SQLite sur disque.
+    Un seul processus l'écrit (sous InterProcessLock), tous les autres le lisent
+    via une connexion par thread, en lecture seule et mappée en mémoire.
+    """
+    MMAP_SIZE = 256 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.classes = _ClassIndexView(self)
+        self.functions = _FunctionIndexView(self)
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute(f"PRAGMA mmap_size={self.MMAP_SIZE}")
+            conn.execute("PRAGMA query_only=ON")
+            self.local.conn = conn
+        return conn
+
+    def query(self, sql, params=()):
+        return self._connection().execute(sql, params).fetchall()
+
+    def fingerprint(self):
+        if not os.path.exists(self.path):
+            return None
+        try:
+            rows = self.query("SELECT value FROM meta WHERE key = 'fingerprint'")
+        except sqlite3.DatabaseError:
+            return None
+        return rows[0][0] if rows else None
+
+    def write(self, class_index, function_index, fingerprint):
+        """Remplace tout le contenu en une transaction : les lecteurs ne voient jamais d'index partiel."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS classes (name TEXT NOT NULL, seq INTEGER NOT NULL, "
+                    "path TEXT NOT NULL, tag TEXT, PRIMARY KEY (name, seq)) WITHOUT ROWID"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS functions (name TEXT PRIMARY KEY, path TEXT NOT NULL) WITHOUT ROWID"
+                )
+                conn.execute("DELETE FROM classes")
+                conn.execute("DELETE FROM functions")
+                conn.executemany("INSERT INTO classes VALUES (?, ?, ?, ?)", (
+                    row for name, entry in class_index.items() for row in (
+                        [(name, 0, entry, None)] if isinstance(entry, str) else
+                        [(name, seq, e['path'], e['tag']) for seq, e in enumerate(entry)]
+                    )
+                ))
+                conn.executemany("INSERT INTO functions VALUES (?, ?)", function_index.items())
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+        finally:
+            conn.close()
+
+class _ClassIndexView:
+    """Accès type dict à la table des classes : chemin du module, ou liste de {'path', 'tag'} en cas de doublon."""
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, name, default=None):
+        rows = self.store.query("SELECT path, tag FROM classes WHERE name = ? ORDER BY seq", (name,))
+        if not rows:
+            return default
+        if len(rows) == 1 and rows[0][1] is None:
+            return rows[0][0]
+        return [{'path': path, 'tag': tag} for path, tag in rows]
+
+    def __contains__(self, name):
+        return bool(self.store.query("SELECT 1 FROM classes WHERE name = ? LIMIT 1", (name,)))
+
+    def __len__(self):
+        return self.store.query("SELECT COUNT(DISTINCT name) FROM classes")[0][0]
+
+class _FunctionIndexView:
+    """Accès type dict à la table des fonctions : nom -> chemin du module."""
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, name, default=None):
+        rows = self.store.query("SELECT path FROM functions WHERE name = ?", (name,))
+        return rows[0][0] if rows else default
+
+    def __contains__(self, name):
+        return bool(self.store.query("SELECT 1 FROM functions WHERE name = ? LIMIT 1", (name,)))
+
+    def __len__(self):
+        return self.store.query("SELECT COUNT(*) FROM functions")[0][0]
+
+def build_indexes(progress=None):
+    with INDEX_LOCK:
+        _build_indexes_locked(progress)
+
+def _list_index_sources():
     comfy_root = os.path.dirname(folder_paths.__file__)
-    
+
     paths_to_scan = folder_paths.get_folder_paths("custom_nodes")
     comfy_extras_path = os.path.join(comfy_root, "comfy_extras")
     if os.path.isdir(comfy_extras_path):
         paths_to_scan.append(comfy_extras_path)
 
+    # Les nœuds compilés ne sont jamais indexés : les exclure évite qu'une
+    # installation invalide l'index partagé.
+    compiled_dir = os.path.abspath(COMPILED_NODES_DIR)
+    files_to_scan = []
+    for scan_path in paths_to_scan:
+        if not os.path.isdir(scan_path):
+            continue
+        for root, dirs, files in os.walk(scan_path):
+            if "venv" in root or ".git" in root:
+                continue
+            dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) != compiled_dir]
+            files_to_scan.extend(os.path.join(root, file) for file in files if file.endswith(".py"))
+    return comfy_root, files_to_scan
+
+def _indexable_node_mappings():
+    """
+    Nœuds chargés à indexer. Les nœuds compilés installés à chaud (subgraph_compiled.*)
+    en sont exclus : find_spec ne les résout pas, et les inclure ferait reconstruire
+    l'index partagé à chaque installation.
+    """
+    return {
+        class_name: class_obj for class_name, class_obj in NODE_CLASS_MAPPINGS.items()
+        if not (getattr(class_obj, '__module__', None) or '').startswith(COMPILED_MODULE_PREFIX)
+    }
+
+def _index_fingerprint(files_to_scan):
+    """Empreinte des sources indexées (chemin, taille, date) et des nœuds chargés."""
+    digest = hashlib.sha256(f"v{INDEX_SCHEMA_VERSION}".encode('utf-8'))
+    for class_name, class_obj in sorted(_indexable_node_mappings().items()):
+        digest.update(f"\0{class_name}={getattr(class_obj, '__module__', '')}".encode('utf-8'))
+    for file_path in sorted(files_to_scan):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            continue
+        digest.update(f"\0{file_path}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8'))
+    return digest.hexdigest()
+
+def _build_indexes_locked(progress):
+    global INDEX_STORE, CLASS_INDEX, FUNCTION_INDEX
+    if INDEX_STORE is not None:
+        if progress:
+            progress.update("index", percent=100, cached=True)
+        return
+
+    comfy_root, files_to_scan = _list_index_sources()
+    fingerprint = _index_fingerprint(files_to_scan)
+    store = IndexStore(INDEX_STORE_PATH)
+
+    if store.fingerprint() == fingerprint:
+        print(f"--- Subgraph Compiler: Index partagé à jour, réutilisé depuis {INDEX_STORE_PATH} ---")
+        cached = True
+    else:
+        with InterProcessLock(INDEX_STORE_PATH + ".lock"):
+            # Un autre processus a pu reconstruire l'index pendant l'attente du verrou
+            cached = store.fingerprint() == fingerprint
+            if not cached:
+                class_index, function_index = _scan_index_sources(comfy_root, files_to_scan, progress)
+                store.write(class_index, function_index, fingerprint)
+
+    INDEX_STORE = store
+    CLASS_INDEX, FUNCTION_INDEX = store.classes, store.functions
+    if progress:
+        progress.update("index", percent=100, files=len(files_to_scan), cached=cached)
+    print(f"--- Subgraph Compiler: Indexes ready. Found {len(CLASS_INDEX)} classes and {len(FUNCTION_INDEX)} functions. ---")
+
+def _scan_index_sources(comfy_root, files_to_scan, progress):
+    print("--- Subgraph Compiler: Building final indexes... ---")
+    # Construction dans des dictionnaires locaux : l'index partagé n'est
+    # écrit qu'une fois complet (une annulation ne laisse rien à moitié fait).
+    class_index = {}
+    function_index = {}
+
+    for class_name, class_obj in _indexable_node_mappings().items():
+        if hasattr(class_obj, '__module__'):
+            class_index[class_name] = class_obj.__module__
+
     base_dir_for_paths = comfy_root
     scanned_files = set()
-    
+
     def _get_tag_from_path(file_path, base_path):
         # Helper pour extraire un tag propre depuis le chemin du fichier
         rel_path = os.path.relpath(os.path.dirname(file_path), base_path)
         return rel_path.replace(os.sep, '_').replace('-', '_')
 
-    for scan_path in paths_to_scan:
-        if not os.path.isdir(scan_path):
+    last_percent = -1
+    for file_index, file_path in enumerate(files_to_scan):
+        if progress:
+            percent = (file_index * 100) // len(files_to_scan)
+            if percent != last_percent:
+                last_percent = percent
+                progress.update("index", percent=percent, files=len(files_to_scan))
+
+        # --- LOG EN ROUGE RÉINTÉGRÉ ---
+        if "nodes_custom_sampler.py" in file_path:
+            print("\033[91m" + f"\n>>> DÉTECTÉ : Analyse du fichier critique : {file_path}" + "\033[0m")
+        
+        if file_path in scanned_files:
             continue
-        for root, _, files in os.walk(scan_path):
-            if "venv" in root or ".git" in root:
-                continue
-            for file in files:
-                if file.endswith(".py"):
-                    file_path = os.path.join(root, file)
-
-                    # --- LOG EN ROUGE RÉINTÉGRÉ ---
-                    if "nodes_custom_sampler.py" in file_path:
-                        print("\033[91m" + f"\n>>> DÉTECTÉ : Analyse du fichier critique : {file_path}" + "\033[0m")
-                    
-                    if file_path in scanned_files:
-                        continue
-                    scanned_files.add(file_path)
-
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                        
-                            # ▼▼▼ AJOUT DE LA VÉRIFICATION DU TAG ▼▼▼
-                            first_line = f.readline().strip()
-                            if first_line == "# ---Don't use this file for build_indexes---":
-                                print(f"  -> Ignoré (fichier venant du compilateur): {file_path}")
-                                continue # Passe au fichier suivant
-                            # ▲▲▲ FIN DE L'AJOUT ▲▲▲
-
-                            # Si on est ici, ce n'est pas un fichier généré, on lit le reste
-                            f.seek(0) # Revenir au début du fichier
-                        
-                            source_code = f.read()
-                        
-                        # ▼▼▼ AJOUT DU FILTRE D'AVERTISSEMENTS ▼▼▼
-                        with warnings.catch_warnings():
-                            # Ignorer spécifiquement les SyntaxWarning pendant l'analyse AST
-                            warnings.filterwarnings("ignore", category=SyntaxWarning)
-                            # L'appel ast.parse() est maintenant à l'intérieur du contexte
-                            tree = ast.parse(source_code)
-                        # ▲▲▲ FIN DE L'AJOUT ▲▲▲
-                                                
-                        rel_path = os.path.relpath(file_path, base_dir_for_paths)
-                        module_path = os.path.splitext(rel_path)[0].replace(os.sep, '.')
-                        
+        scanned_files.add(file_path)
 
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+            
+                # ▼▼▼ AJOUT DE LA VÉRIFICATION DU TAG ▼▼▼
+                first_line = f.readline().strip()
+                if first_line == GENERATED_FILE_HEADER:
+                    print(f"  -> Ignoré (fichier venant du compilateur): {file_path}")
+                    continue # Passe au fichier suivant
+                # ▲▲▲ FIN DE L'AJOUT ▲▲▲
+
+                # Si on est ici, ce n'est pas un fichier généré, on lit le reste
+                f.seek(0) # Revenir au début du fichier
+            
+                source_code = f.read()
+            
+            # ▼▼▼ AJOUT DU FILTRE D'AVERTISSEMENTS ▼▼▼
+            with warnings.catch_warnings():
+                # Ignorer spécifiquement les SyntaxWarning pendant l'analyse AST
+                warnings.filterwarnings("ignore", category=SyntaxWarning)
+                # L'appel ast.parse() est maintenant à l'intérieur du contexte
+                tree = ast.parse(source_code)
+            # ▲▲▲ FIN DE L'AJOUT ▲▲▲
+                                    
+            rel_path = os.path.relpath(file_path, base_dir_for_paths)
+            module_path = os.path.splitext(rel_path)[0].replace(os.sep, '.')
+            
 
-                        for node in ast.walk(tree):
-                            if isinstance(node, ast.ClassDef):
-                                class_name = node.name
-                                if class_name not in CLASS_INDEX:
-                                    # Cas normal : première fois qu'on voit ce nom
-                                    CLASS_INDEX[class_name] = module_path
-                                else:
-                                 if class_name in ['NunchakuQwenImage', 'Attention']:
-                                    print(f"⚠️  Doublon détecté pour la classe '{class_name}'. Ajout d'une nouvelle version depuis '{module_path}'.")
-                                    # On a une collision !
-                                    existing_entry = CLASS_INDEX[class_name]
-                                    new_entry = {'path': module_path, 'tag': _get_tag_from_path(file_path, base_dir_for_paths)}
-
-                                    if isinstance(existing_entry, str):
-                                        # Première collision pour ce nom. On transforme l'entrée existante.
-                                        old_path = existing_entry
-                                        # Pour trouver le fichier original de l'entrée existante, on doit faire un peu de travail
-                                        old_file_path = old_path.replace('.', os.sep) + '.py'
-                                        full_old_path = os.path.join(base_dir_for_paths, old_file_path)
-                                      
-                                        old_tag = _get_tag_from_path(full_old_path, base_dir_for_paths)
-                                        CLASS_INDEX[class_name] = [
-                                            {'path': old_path, 'tag': old_tag},
-                                            new_entry
-                                        ]
-                                    elif isinstance(existing_entry, list):
-                                        # Il y avait déjà des collisions, on ajoute à la liste.
-                                        CLASS_INDEX[class_name].append(new_entry)
-                                 else:
-                                      pass
-                            elif isinstance(node, ast.FunctionDef):
-                                # On garde la logique simple pour les fonctions pour l'instant
-                                if node.name not in FUNCTION_INDEX:
-                                    FUNCTION_INDEX[node.name] = module_path
-                        # ▲▲▲ FIN DE LA MODIFICATION ▲▲▲
-                    except Exception:
-                        continue
-
-    print(f"--- Subgraph Compiler: Indexes built. Found {len(CLASS_INDEX)} classes and {len(FUNCTION_INDEX)} functions. ---")
+
+            for node in ast.walk(tree):
+                if isinstance(node, ast.ClassDef):
+                    class_name = node.name
+                    if class_name not in class_index:
+                        # Cas normal : première fois qu'on voit ce nom
+                        class_index[class_name] = module_path
+                    else:
+                     if class_name in ['NunchakuQwenImage', 'Attention']:
+                        print(f"⚠️  Doublon détecté pour la classe '{class_name}'. Ajout d'une nouvelle version depuis '{module_path}'.")
+                        # On a une collision !
+                        existing_entry = class_index[class_name]
+                        new_entry = {'path': module_path, 'tag': _get_tag_from_path(file_path, base_dir_for_paths)}
+
+                        if isinstance(existing_entry, str):
+                            # Première collision pour ce nom. On transforme l'entrée existante.
+                            old_path = existing_entry
+                            # Pour trouver le fichier original de l'entrée existante, on doit faire un peu de travail
+                            old_file_path = old_path.replace('.', os.sep) + '.py'
+                            full_old_path = os.path.join(base_dir_for_paths, old_file_path)
+                          
+                            old_tag = _get_tag_from_path(full_old_path, base_dir_for_paths)
+                            class_index[class_name] = [
+                                {'path': old_path, 'tag': old_tag},
+                                new_entry
+                            ]
+                        elif isinstance(existing_entry, list):
+                            # Il y avait déjà des collisions, on ajoute à la liste.
+                            class_index[class_name].append(new_entry)
+                     else:
+                          pass
+                elif isinstance(node, ast.FunctionDef):
+                    # On garde la logique simple pour les fonctions pour l'instant
+                    if node.name not in function_index:
+                        function_index[node.name] = module_path
+            # ▲▲▲ FIN DE LA MODIFICATION ▲▲▲
+        except Exception:
+            continue
+
+    print(f"--- Subgraph Compiler: Indexes built. Found {len(class_index)} classes and {len(function_index)} functions. ---")
+    return class_index, function_index
 
 # ===============================================================
 # --- COMPILATEUR MINIMALISTE ("ZEN") ---
 # ===============================================================
+BUILTIN_NAMES = frozenset(dir(builtins))
+
+def find_free_global_names(code):
+    """
+    Renvoie, dans l'ordre d'apparition, les noms du code qui se résolvent au niveau
+    module. Paramètres, variables locales, noms importés localement et attributs
+    sont écartés grâce à la table des symboles (module symtable).
+    """
+    free_names = set()
+    def visit(table):
+        for symbol in table.get_symbols():
+            if symbol.is_referenced() and symbol.is_global():
+                free_names.add(symbol.get_name())
+        for child in table.get_children():
+            visit(child)
+    visit(symtable.symtable(code, "<segment>", "exec"))
+
+    ordered = {}
+    for node in ast.walk(ast.parse(code)):
+        if isinstance(node, ast.Name) and node.id in free_names:
+            ordered.setdefault(node.id, None)
+    return list(ordered)
+
+def _module_import_bindings(file_tree):
+    """Noms liés par les imports du module : nom -> niveau (0 = absolu, >0 = relatif)."""
+    bindings = {}
+    def visit(node):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                continue
+            if isinstance(child, ast.Import):
+                for alias in child.names:
+                    bindings[alias.asname or alias.name.split('.')[0]] = 0
+            elif isinstance(child, ast.ImportFrom):
+                for alias in child.names:
+                    if alias.name != '*':
+                        bindings[alias.asname or alias.name] = child.level
+            else:
+                visit(child)
+    visit(file_tree)
+    return bindings
+
+def filter_imports(import_lines, code):
+    """Ne garde que les lignes d'import dont au moins un nom est utilisé dans le code."""
+    final_imports = set()
+    try:
+        final_tree = ast.parse(code)
+        used_names = {node.id for node in ast.walk(final_tree) if isinstance(node, ast.Name)}
+        for imp_line in import_lines:
+            try:
+                imp_node = ast.parse(imp_line).body[0]
+                module_name = ""
+                if isinstance(imp_node, ast.Import):
+                    module_name = imp_node.names[0].name
+                elif isinstance(imp_node, ast.ImportFrom):
+                    module_name = imp_node.module
+                
+                if module_name in IGNORE_IMPORTS:
+                    continue
+
+                keep_import = False
+                if isinstance(imp_node, ast.Import):
+                    for alias in imp_node.names:
+                        if (alias.asname or alias.name).split('.')[0] in used_names:
+                            keep_import = True; break
+                elif isinstance(imp_node, ast.ImportFrom):
+                    if imp_node.module and imp_node.module.split('.')[0] in used_names:
+                        keep_import = True
+                    else:
+                        for alias in imp_node.names:
+                            if (alias.asname or alias.name) in used_names:
+                                keep_import = True; break
+                if keep_import:
+                    final_imports.add(imp_line)
+            except Exception: pass
+    except Exception: pass
+    return final_imports
+
+class ResolutionBudget:
+    """Limites de DependencyResolver.resolve. Au-delà, les noms sont importés au lieu d'être intégrés."""
+    def __init__(self, max_symbols=None, max_files=None, max_depth=None, max_seconds=None):
+        self.max_symbols = max_symbols
+        self.max_files = max_files
+        self.max_depth = max_depth
+        self.max_seconds = max_seconds
+        self.start = time.monotonic()
+
+    def exceeded(self, depth, symbols, files, opens_new_file=False):
+        """Renvoie la limite dépassée, ou None."""
+        if self.max_seconds is not None and time.monotonic() - self.start > self.max_seconds:
+            return 'max_seconds'
+        if self.max_depth is not None and depth > self.max_depth:
+            return 'max_depth'
+        if self.max_symbols is not None and symbols >= self.max_symbols:
+            return 'max_symbols'
+        if opens_new_file and self.max_files is not None and files >= self.max_files:
+            return 'max_files'
+        return None
+
+def parse_resolution_budget(overrides):
+    """
+    Fusionne les surcharges d'une requête ("budget") avec RESOLUTION_BUDGET.
+    Lève ValueError pour une clé inconnue ou une valeur qui n'est ni un nombre positif ni null.
+    """
+    if overrides is None:
+        overrides = {}
+    if not isinstance(overrides, dict):
+        raise ValueError(f"'budget' doit être un objet, reçu: {overrides!r}.")
+    unknown = sorted(set(overrides) - set(RESOLUTION_BUDGET))
+    if unknown:
+        raise ValueError(f"Clé(s) de budget inconnue(s): {unknown} (attendu: {sorted(RESOLUTION_BUDGET)}).")
+    for key, value in overrides.items():
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+            raise ValueError(f"Valeur de budget invalide pour '{key}': {value!r} (nombre positif ou null attendu).")
+    return {**RESOLUTION_BUDGET, **overrides}
+
+def _is_importable_path(module_path):
+    return all(part.isidentifier() for part in module_path.split('.'))
+
 class DependencyResolver:
     def __init__(self, node_class_mappings):
         self.node_class_mappings = node_class_mappings
         self.class_index = CLASS_INDEX
         self.function_index = FUNCTION_INDEX
         self.rename_map = {} # Pour suivre les renommages
+        self.definition_imports = {} # Imports absolus du fichier source de chaque définition
+        self.budget_imports = set() # Imports des noms coupés par le budget
         self.dependency_graph = {}
+        self.budget_cuts = [] # Noms coupés par le budget : importés, ou intégrés sans leurs dépendances
         
-    def resolve(self, initial_class_names):
+    def resolve(self, initial_class_names, progress=None, budget=None):
         print("\n--- DÉMARRAGE DE LA RÉSOLUTION (Finale + Tri Topologique) ---")
         
-        # La liste IGNORE_DEPS (sans sd, metadata, state_dict)
-        IGNORE_DEPS = {
-            '_', 'self', 'cls', 'i', 'x', 'f', 'k', 'v', 's', 't', 'e', 'ret',
-            'args', 'kwargs', 'name', 'path', 'shape', 'next', 'CATEGORY', 'filter',
-            'common_ksampler', 'sampler', 'noise', 'text', 'total', 'round', 'rank', 'h', 'add', 'max',
-            'index', 'in_channels', 'control', 'out_channels', 'scale', 'dim', 'shift', 'warn', 'block_wrap',
-            'node', 'model', 'clip', 'image', 'images', 'vae', 'seed', 'steps', 'cfg', 'sampler_name', 
-            'scheduler', 'positive', 'negative', 'latent', 'latent_image', 'denoise', 'prompt', 'pixels', 
-            'samples', 'conditioning', 'callback', 'dtype', 'device', 'self_attn', 'width', 'height', 'batch_size', 'percent',
-            'int', 'str', 'float', 'bool', 'list', 'dict', 'tuple', 'set', 'any', 'Any',
-            'None', 'True', 'False', 'res', 'sample', 'step', 'prepare_noise', 'sigma', 'timestep'
-        }
-
         stack = list(initial_class_names)
-        processed_names = set(dir(__builtins__))
+        processed_names = set(BUILTIN_NAMES)
         all_code_blocks = {}
         all_imports = set()
         self.dependency_graph = {}
+        budget = budget or ResolutionBudget()
+        depth_of = {name: 0 for name in stack}
+        budget_imports = set()
+        self.definition_imports = {}
+        self.budget_cuts = []
+        # Chaque fichier source n'est lu et analysé qu'une fois par résolution
+        parsed_files = {}
 
         while stack:
             name = stack.pop()
@@ -242,6 +631,23 @@ class DependencyResolver:
                     processed_names.add(final_name)
                     continue
 
+                cut_reason = budget.exceeded(depth_of.get(name, 0), len(all_code_blocks), len(parsed_files),
+                                             opens_new_file=source_file not in parsed_files)
+                if cut_reason and not _is_importable_path(module_path):
+                    # Un module au nom non importable (ex: pack avec tirets) ne peut pas être importé :
+                    # le bloc est intégré, mais ses dépendances ne sont plus explorées.
+                    print(f"  -> BUDGET ({cut_reason}) : '{final_name}' intégré sans ses dépendances ('{module_path}' non importable).")
+                    self.budget_cuts.append({'name': final_name, 'module': module_path, 'reason': cut_reason, 'action': 'inline'})
+                elif cut_reason:
+                    print(f"  -> BUDGET ({cut_reason}) : '{final_name}' sera importé depuis '{module_path}'.")
+                    alias = f" as {final_name}" if final_name != name else ""
+                    budget_imports.add(f"from {module_path} import {name}{alias}")
+                    self.budget_cuts.append({'name': final_name, 'module': module_path, 'reason': cut_reason, 'action': 'import'})
+                    processed_names.add(final_name)
+                    if not should_rename and is_duplicate_entry:
+                        processed_names.add(name)
+                    continue
+
                 processed_names.add(final_name)
                 if not should_rename and is_duplicate_entry:
                     processed_names.add(name)
@@ -249,11 +655,19 @@ class DependencyResolver:
                 print(f"  -> Fichier source : {source_file}")
 
                 try:
-                    with open(source_file, 'r', encoding='utf-8') as f:
-                        source_code = f.read()
-
-                    file_tree = ast.parse(source_code)
-                    definitions_in_file = {node.name: node for node in ast.walk(file_tree) if isinstance(node, (ast.FunctionDef, ast.ClassDef))}
+                    if source_file not in parsed_files:
+                        with open(source_file, 'r', encoding='utf-8') as f:
+                            source_code = f.read()
+                        file_tree = ast.parse(source_code)
+                        parsed_files[source_file] = (
+                            source_code,
+                            file_tree,
+                            {node.name: node for node in ast.walk(file_tree) if isinstance(node, (ast.FunctionDef, ast.ClassDef))},
+                            {ast.unparse(node) for node in ast.walk(file_tree)
+                             if (isinstance(node, ast.ImportFrom) and node.level == 0) or isinstance(node, ast.Import)},
+                            _module_import_bindings(file_tree),
+                        )
+                    source_code, file_tree, definitions_in_file, file_imports, module_imports = parsed_files[source_file]
 
                     target_node = definitions_in_file.get(name)
                     if target_node:
@@ -268,38 +682,42 @@ class DependencyResolver:
                         if final_name in all_code_blocks: continue
                         all_code_blocks[final_name] = code_segment
                         print(f"  -> Code pour '{final_name}' collecté.")
+                        if progress:
+                            progress.update("resolve", resolved=len(all_code_blocks), pending=len(stack))
 
-                        for node in ast.walk(file_tree):
-                            if isinstance(node, ast.ImportFrom) and node.level == 0: all_imports.add(ast.unparse(node))
-                            elif isinstance(node, ast.Import): all_imports.add(ast.unparse(node))
+                        all_imports |= file_imports
+                        self.definition_imports[final_name] = file_imports
                         
-                        code_segment = code_segment.replace('model_base.NunchakuQwenImage', 'NunchakuQwenImage')
+                        # Les règles 'rename' de PATCH_RULES s'appliquent avant la recherche des dépendances
+                        discovery_code = rename_for_discovery(code_segment, self.rename_map)
                         print(f"  -> Analyse des dépendances pour '{final_name}'...")
-                        segment_tree = ast.parse(code_segment)
                         dependencies_found = []
                         self.dependency_graph.setdefault(final_name, set())
-                        for node in ast.walk(segment_tree):
-                            if isinstance(node, ast.Name):
-                                dep_name = node.id
-
-                                if dep_name in IGNORE_DEPS:
-                                    continue
-
-                                is_a_dependency = dep_name in definitions_in_file or dep_name in self.class_index or dep_name in self.function_index
+                        # Seuls les noms libres (globaux) comptent : paramètres, variables locales
+                        # et attributs sont écartés par la table des symboles.
+                        for dep_name in find_free_global_names(discovery_code):
+                            # Fourni par un import absolu du module : l'import sera conservé tel quel
+                            if module_imports.get(dep_name) == 0:
+                                continue
+                            if dep_name in BUILTIN_NAMES and dep_name not in definitions_in_file:
+                                continue
+
+                            is_a_dependency = dep_name in definitions_in_file or dep_name in self.class_index or dep_name in self.function_index
+                            
+                            if is_a_dependency:
+                                # Log de débogage pour voir ce qu'il se passe
+                                print(f"    -> Dépendance potentielle identifiée: '{dep_name}'")
                                 
-                                if is_a_dependency:
-                                    # Log de débogage pour voir ce qu'il se passe
-                                    print(f"    -> Dépendance potentielle identifiée: '{dep_name}'")
-                                    
-                                    # La condition la plus simple possible :
-                                    if dep_name != final_name:
-                                        print(f"      -> ✅ Ajout de la dépendance: '{final_name}' -> '{dep_name}'")
-                                        self.dependency_graph[final_name].add(dep_name)
-                                    else:
-                                        print(f"      -> ❌ Ignoré (auto-dépendance): '{dep_name}'")
-
-                                    if dep_name not in processed_names and dep_name not in stack:
-                                        dependencies_found.append(dep_name)
+                                # La condition la plus simple possible :
+                                if dep_name != final_name:
+                                    print(f"      -> ✅ Ajout de la dépendance: '{final_name}' -> '{dep_name}'")
+                                    self.dependency_graph[final_name].add(dep_name)
+                                else:
+                                    print(f"      -> ❌ Ignoré (auto-dépendance): '{dep_name}'")
+
+                                if dep_name not in processed_names and dep_name not in stack and not cut_reason:
+                                    dependencies_found.append(dep_name)
+                                    depth_of.setdefault(dep_name, depth_of.get(name, 0) + 1)
                         
                         if dependencies_found:
                             print(f"  -> Dépendances découvertes : {list(set(dependencies_found))}")
@@ -307,6 +725,8 @@ class DependencyResolver:
                         else:
                             print("  -> Fin de cette branche de dépendances.")
 
+                except CompileCancelled:
+                    raise
                 except Exception as e:
                     print(f"  -> ERREUR lors de l'analyse de '{name}': {e}")
                     traceback.print_exc()
@@ -332,38 +752,12 @@ class DependencyResolver:
             print(f"  -> ERREUR: Dépendance circulaire détectée: {e}. Utilisation de l'ordre par défaut.")
             final_bundle_code = "\n\n".join(all_code_blocks.values())
         
-        final_imports = set()
-        try:
-            final_tree = ast.parse(final_bundle_code)
-            used_names = {node.id for node in ast.walk(final_tree) if isinstance(node, ast.Name)}
-            for imp_line in all_imports:
-                try:
-                    imp_node = ast.parse(imp_line).body[0]
-                    module_name = ""
-                    if isinstance(imp_node, ast.Import):
-                        module_name = imp_node.names[0].name
-                    elif isinstance(imp_node, ast.ImportFrom):
-                        module_name = imp_node.module
-                    
-                    if module_name in IGNORE_IMPORTS:
-                        continue
-
-                    keep_import = False
-                    if isinstance(imp_node, ast.Import):
-                        for alias in imp_node.names:
-                            if (alias.asname or alias.name).split('.')[0] in used_names:
-                                keep_import = True; break
-                    elif isinstance(imp_node, ast.ImportFrom):
-                        if imp_node.module and imp_node.module.split('.')[0] in used_names:
-                            keep_import = True
-                        else:
-                            for alias in imp_node.names:
-                                if (alias.asname or alias.name) in used_names:
-                                    keep_import = True; break
-                    if keep_import:
-                        final_imports.add(imp_line)
-                except Exception: pass
-        except Exception: pass
+        final_imports = filter_imports(all_imports, final_bundle_code)
+        # Les noms coupés par le budget sont toujours importés (le nœud principal peut en dépendre)
+        final_imports |= budget_imports
+        self.budget_imports = budget_imports
+        if self.budget_cuts:
+            print(f"--- BUDGET: {len(self.budget_cuts)} nom(s) coupé(s) par le budget de résolution. ---")
 
         return final_imports, final_bundle_code
         
@@ -373,7 +767,7 @@ def get_dynamic_input_str_from_source(class_name, input_name):
     sous forme de chaîne de caractères, sans l'évaluer.
     Cible les appels de fonction (ast.Call) et les accès à des attributs (ast.Attribute).
     """
-    if not class_name or not input_name or not CLASS_INDEX:
+    if not class_name or not input_name or CLASS_INDEX is None:
         return None
 
     module_path = CLASS_INDEX.get(class_name)
@@ -436,6 +830,365 @@ def get_dynamic_input_str_from_source(class_name, input_name):
         
     return None
 
+# ===============================================================
+# --- ANALYSE DU SOUS-GRAPHE (CÔTÉ SERVEUR) ---
+# ===============================================================
+SUBGRAPH_IO_NODE_TYPES = {'GraphInput', 'GraphOutput'}
+
+def _normalize_link(link):
+    """Accepte un lien au format objet (définition de subgraph) ou tableau (workflow)."""
+    if isinstance(link, dict):
+        return {
+            'id': link.get('id'),
+            'origin_id': link.get('origin_id'),
+            'origin_slot': link.get('origin_slot'),
+            'target_id': link.get('target_id'),
+            'target_slot': link.get('target_slot'),
+        }
+    # Format tableau : [id, origin_id, origin_slot, target_id, target_slot, type]
+    link_id, origin_id, origin_slot, target_id, target_slot = link[:5]
+    return {'id': link_id, 'origin_id': origin_id, 'origin_slot': origin_slot,
+            'target_id': target_id, 'target_slot': target_slot}
+
+def extract_subgraph_definition(payload, subgraph_id=None):
+    """
+    Retrouve la définition d'un subgraph dans ce que le client a envoyé :
+    soit la définition elle-même, soit un workflow complet (definitions.subgraphs).
+    """
+    subgraphs = (payload.get('definitions') or {}).get('subgraphs')
+    if subgraphs is None:
+        return payload
+    if not subgraphs:
+        raise ValueError("Le workflow ne contient aucune définition de subgraph.")
+    if subgraph_id is None:
+        return subgraphs[0]
+    for subgraph in subgraphs:
+        if subgraph.get('id') == subgraph_id:
+            return subgraph
+    raise ValueError(f"Subgraph '{subgraph_id}' introuvable dans le workflow.")
+
+def analyze_subgraph(subgraph):
+    """
+    Calcule l'ioMap, les liens internes et l'ordre d'exécution d'un subgraph.
+    Le tri topologique (Kahn) utilise des listes d'adjacence : O(nœuds + liens).
+    """
+    nodes = [n for n in subgraph.get('nodes', []) if n]
+    nodes_by_id = {n['id']: n for n in nodes}
+    links = [_normalize_link(l) for l in subgraph.get('links', []) if l]
+    parent_inputs = subgraph.get('inputs', [])
+    parent_outputs = subgraph.get('outputs', [])
+
+    def _class_name(node):
+        return node.get('class_name') or node.get('type')
+
+    io_map = {'inputs': {}, 'outputs': {}}
+    internal_links = []
+    outgoing = defaultdict(list)
+    in_degree = {node_id: 0 for node_id in nodes_by_id}
+
+    for link in links:
+        origin_is_internal = link['origin_id'] in nodes_by_id
+        target_is_internal = link['target_id'] in nodes_by_id
+
+        if not origin_is_internal and target_is_internal:
+            target_node = nodes_by_id[link['target_id']]
+            slot = link['origin_slot']
+            input_on_parent = parent_inputs[slot] if slot is not None and 0 <= slot < len(parent_inputs) else None
+            target_inputs = target_node.get('inputs', [])
+            target_slot = link['target_slot']
+            if input_on_parent and target_slot is not None and 0 <= target_slot < len(target_inputs):
+                io_map['inputs'][input_on_parent['name']] = {
+                    'name': input_on_parent['name'],
+                    'type': input_on_parent.get('type'),
+                    'targetNodeId': link['target_id'],
+                    'targetNodeSlot': link['target_slot'],
+                    'originalClassName': _class_name(target_node),
+                    'originalInputName': target_inputs[link['target_slot']]['name'],
+                }
+        elif origin_is_internal and not target_is_internal:
+            slot = link['target_slot']
+            output_on_parent = parent_outputs[slot] if slot is not None and 0 <= slot < len(parent_outputs) else None
+            if output_on_parent:
+                io_map['outputs'][output_on_parent['name']] = {
+                    'name': output_on_parent['name'],
+                    'type': output_on_parent.get('type'),
+                    'originNodeId': link['origin_id'],
+                    'originNodeSlot': link['origin_slot'],
+                }
+        elif origin_is_internal and target_is_internal:
+            internal_links.append(link)
+            outgoing[link['origin_id']].append(link['target_id'])
+            in_degree[link['target_id']] += 1
+
+    queue = deque(node_id for node_id in nodes_by_id if in_degree[node_id] == 0)
+    ordered_ids = []
+    while queue:
+        node_id = queue.popleft()
+        ordered_ids.append(node_id)
+        for target_id in outgoing[node_id]:
+            in_degree[target_id] -= 1
+            if in_degree[target_id] == 0:
+                queue.append(target_id)
+
+    if len(ordered_ids) < len(nodes_by_id):
+        print(f"  -> AVERTISSEMENT: Cycle détecté, {len(nodes_by_id) - len(ordered_ids)} nœud(s) ignoré(s).")
+
+    execution_order = []
+    for node_id in ordered_ids:
+        node = nodes_by_id[node_id]
+        if node.get('type') in SUBGRAPH_IO_NODE_TYPES:
+            continue
+        class_name = _class_name(node)
+        entry = {
+            'id': node_id,
+            'title': node.get('title') or NODE_DISPLAY_NAME_MAPPINGS.get(class_name) or class_name,
+            'type': node.get('type'),
+            'class_name': class_name,
+            'inputs': [{'name': i.get('name'), 'type': i.get('type')} for i in node.get('inputs') or []],
+            'outputs': [{'name': o.get('name'), 'type': o.get('type')} for o in node.get('outputs') or []],
+        }
+        # Les définitions brutes portent les valeurs des widgets : la génération en a besoin
+        for key in ('widgets_values', 'mode'):
+            if key in node:
+                entry[key] = node[key]
+        execution_order.append(entry)
+
+    return {'ioMap': io_map, 'internalLinks': internal_links, 'executionOrder': execution_order}
+
+# ===============================================================
+# --- MOTEUR DE PATCHS AST ---
+# ===============================================================
+# Règles appliquées au code collecté, en une seule passe AST. Formats :
+#   {'kind': 'rename', 'old': 'a.b.Nom', 'new': 'Nom'}
+#       remplace chaque référence (nom ou attribut pointé) par l'expression 'new'
+#   {'kind': 'base', 'cls': 'Classe', 'old': 'Parent', 'new': 'module.Parent'}
+#       change la classe parente de 'Classe', y compris dans ses appels super(Parent, self)
+#   {'kind': 'call', 'func': 'Nom', 'target': 'self.attr', 'replace_func': 'Autre'}
+#   {'kind': 'call', 'func': 'Nom', 'target': 'var', 'replace_call': 'Autre({...})'}
+#       réécrit les appels à 'func' (optionnellement seulement ceux affectés à 'target')
+# 'when_renamed': (...) active la règle seulement si le resolver a renommé une classe
+# dont le nom contient toutes ces chaînes ; '{renamed}' est alors remplacé par ce nom.
+PATCH_RULES = [
+    # Nunchaku doit appeler sa propre version de Attention
+    {'kind': 'call', 'func': 'Attention', 'target': 'self.attn', 'replace_func': '{renamed}',
+     'when_renamed': ('Attention', 'nunchaku')},
+    # Le modèle Nunchaku hérite du QwenImage de ComfyUI, pas de sa propre config renommée
+    {'kind': 'base', 'cls': 'NunchakuQwenImage', 'old': 'QwenImage', 'new': 'comfy.model_base.QwenImage',
+     'when_renamed': ('NunchakuQwenImage', 'configs')},
+    {'kind': 'call', 'func': 'NunchakuQwenImage', 'target': 'model_config',
+     'replace_call': "{renamed}({'image_model': 'qwen_image', 'scale_shift': 0, 'rank': rank, 'precision': precision})",
+     'when_renamed': ('NunchakuQwenImage', 'configs')},
+    # Import relatif 'model_base' : la classe est définie dans le fichier généré
+    {'kind': 'rename', 'old': 'model_base.NunchakuQwenImage', 'new': 'NunchakuQwenImage',
+     'when_renamed': ('NunchakuQwenImage', 'configs')},
+]
+PATCH_RULE_KINDS = {'rename', 'base', 'call'}
+# Clés obligatoires par type de règle, et clés dont la valeur est une expression Python
+PATCH_RULE_REQUIRED_KEYS = {'rename': ('old', 'new'), 'base': ('cls', 'old', 'new'), 'call': ('func',)}
+PATCH_RULE_EXPR_KEYS = ('new', 'replace_func', 'replace_call')
+# Règles utilisateur optionnelles (liste JSON au format de PATCH_RULES)
+USER_PATCH_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "patch_rules.json")
+
+def validate_patch_rule(rule):
+    """Lève ValueError si la règle est incomplète ou si une expression de remplacement ne se parse pas."""
+    if not isinstance(rule, dict):
+        raise ValueError(f"Une règle de patch doit être un objet, reçu: {rule!r}.")
+    kind = rule.get('kind')
+    if kind not in PATCH_RULE_KINDS:
+        raise ValueError(f"Type de règle inconnu: {kind!r} (attendu: {sorted(PATCH_RULE_KINDS)}).")
+    missing = [key for key in PATCH_RULE_REQUIRED_KEYS[kind] if not isinstance(rule.get(key), str) or not rule[key]]
+    if missing:
+        raise ValueError(f"Règle '{kind}' incomplète, clé(s) manquante(s) ou vide(s): {missing}.")
+    if kind == 'call' and ('replace_func' in rule) == ('replace_call' in rule):
+        raise ValueError(f"Règle 'call:{rule['func']}' : il faut exactement une clé parmi 'replace_func' et 'replace_call'.")
+    when_renamed = rule.get('when_renamed')
+    if when_renamed is not None and (isinstance(when_renamed, str) or not all(isinstance(p, str) for p in when_renamed)):
+        raise ValueError(f"Règle {_rule_label(rule)} : 'when_renamed' doit être une liste de chaînes.")
+    for key in PATCH_RULE_EXPR_KEYS:
+        if key not in rule:
+            continue
+        if not isinstance(rule[key], str):
+            raise ValueError(f"Règle {_rule_label(rule)} : '{key}' doit être une chaîne.")
+        try:
+            # '{renamed}' n'est substitué qu'à la compilation : on le remplace par un nom valide
+            _parse_expr(rule[key].replace('{renamed}', 'renamed'))
+        except SyntaxError as e:
+            raise ValueError(f"Règle {_rule_label(rule)} : '{key}' n'est pas une expression valide ({e.msg}).")
+
+def register_patch_rule(rule):
+    """Ajoute une règle de patch (voir PATCH_RULES pour le format) après l'avoir validée."""
+    validate_patch_rule(rule)
+    PATCH_RULES.append(rule)
+
+def load_user_patch_rules():
+    if not os.path.isfile(USER_PATCH_RULES_FILE):
+        return
+    try:
+        with open(USER_PATCH_RULES_FILE, 'r', encoding='utf-8') as f:
+            rules = json.load(f)
+        if not isinstance(rules, list):
+            raise ValueError("le fichier doit contenir une liste de règles")
+    except Exception as e:
+        print(f"  -> ERREUR lors du chargement de '{USER_PATCH_RULES_FILE}': {e}")
+        return
+    loaded = 0
+    for index, rule in enumerate(rules):
+        try:
+            if isinstance(rule, dict) and isinstance(rule.get('when_renamed'), list):
+                rule['when_renamed'] = tuple(rule['when_renamed'])
+            register_patch_rule(rule)
+            loaded += 1
+        except ValueError as e:
+            # Une règle invalide est rejetée ici, pas à chaque compilation
+            print(f"  -> Règle de patch #{index} ignorée ({USER_PATCH_RULES_FILE}): {e}")
+    print(f"  -> {loaded}/{len(rules)} règle(s) de patch chargée(s) depuis {USER_PATCH_RULES_FILE}")
+
+def _dotted_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        base = _dotted_name(node.value)
+        return f"{base}.{node.attr}" if base else None
+    return None
+
+def _rule_label(rule):
+    key = {'rename': 'old', 'base': 'cls', 'call': 'func'}[rule['kind']]
+    return f"{rule['kind']}:{rule[key]}"
+
+def _parse_expr(source):
+    return ast.parse(source, mode='eval').body
+
+def _active_patch_rules(rename_map):
+    """Sélectionne les règles applicables et remplace '{renamed}' par la classe renommée."""
+    renamed_names = list(rename_map.values())
+    active = []
+    for rule in PATCH_RULES:
+        required = rule.get('when_renamed')
+        if not required:
+            active.append(rule)
+            continue
+        renamed = next((n for n in renamed_names if all(part in n for part in required)), None)
+        if renamed:
+            active.append({k: v.replace('{renamed}', renamed) if isinstance(v, str) else v for k, v in rule.items()})
+    return active
+
+class PatchTransformer(ast.NodeTransformer):
+    def __init__(self, rules):
+        self.renames = {r['old']: _parse_expr(r['new']) for r in rules if r['kind'] == 'rename'}
+        self.bases = defaultdict(dict)
+        for r in rules:
+            if r['kind'] == 'base':
+                self.bases[r['cls']][r['old']] = _parse_expr(r['new'])
+        self.calls = [r for r in rules if r['kind'] == 'call']
+        self.class_stack = []
+        self.applied = defaultdict(int)
+
+    def _replacement(self, expr, original):
+        return ast.copy_location(copy.deepcopy(expr), original)
+
+    def _rewrite_call(self, call, rule):
+        if 'replace_call' in rule:
+            call = self._replacement(_parse_expr(rule['replace_call']), call)
+        else:
+            call.func = self._replacement(_parse_expr(rule['replace_func']), call.func)
+        self.applied[_rule_label(rule)] += 1
+        return call
+
+    def visit_ClassDef(self, node):
+        rewrites = self.bases.get(node.name, {})
+        for i, base in enumerate(node.bases):
+            if _dotted_name(base) in rewrites:
+                node.bases[i] = self._replacement(rewrites[_dotted_name(base)], base)
+                self.applied[f"base:{node.name}"] += 1
+        self.class_stack.append(node.name)
+        self.generic_visit(node)
+        self.class_stack.pop()
+        return node
+
+    def visit_Assign(self, node):
+        if isinstance(node.value, ast.Call):
+            targets = {_dotted_name(t) for t in node.targets}
+            func = _dotted_name(node.value.func)
+            for rule in self.calls:
+                if rule.get('target') in targets and rule['func'] == func:
+                    node.value = self._rewrite_call(node.value, rule)
+                    break
+        return self.generic_visit(node)
+
+    def visit_Call(self, node):
+        func = _dotted_name(node.func)
+        # super(Parent, self) dans une classe dont le parent a été réécrit
+        if func == 'super' and node.args and self.class_stack:
+            rewrites = self.bases.get(self.class_stack[-1], {})
+            parent = _dotted_name(node.args[0])
+            if parent in rewrites:
+                node.args[0] = self._replacement(rewrites[parent], node.args[0])
+                self.applied[f"base:{self.class_stack[-1]}"] += 1
+        for rule in self.calls:
+            if 'target' not in rule and rule['func'] == func:
+                node = self._rewrite_call(node, rule)
+                break
+        return self.generic_visit(node)
+
+    def _visit_reference(self, node):
+        if isinstance(node.ctx, ast.Load):
+            dotted = _dotted_name(node)
+            if dotted in self.renames:
+                self.applied[f"rename:{dotted}"] += 1
+                return self._replacement(self.renames[dotted], node)
+        return self.generic_visit(node)
+
+    visit_Name = _visit_reference
+    visit_Attribute = _visit_reference
+
+def _discovery_rename_rules(rename_map):
+    """
+    Règles 'rename' utilisées pendant la résolution. Une règle conditionnelle dont le
+    remplacement n'utilise pas '{renamed}' est incluse même si sa condition n'est pas
+    encore remplie : c'est la résolution de sa cible qui la remplira.
+    """
+    rules = {r['old']: r for r in _active_patch_rules(rename_map) if r['kind'] == 'rename'}
+    for rule in PATCH_RULES:
+        if rule['kind'] == 'rename' and rule['old'] not in rules and '{renamed}' not in rule['new']:
+            rules[rule['old']] = rule
+    return list(rules.values())
+
+def rename_for_discovery(code, rename_map):
+    """Applique les règles 'rename' à un segment avant d'en chercher les noms libres."""
+    rules = _discovery_rename_rules(rename_map)
+    if not rules:
+        return code
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code
+    transformer = PatchTransformer(rules)
+    tree = transformer.visit(tree)
+    return ast.unparse(tree) if transformer.applied else code
+
+def apply_patch_rules(definitions_code, rename_map):
+    """Applique les règles actives au code collecté, en une seule passe AST."""
+    rules = _active_patch_rules(rename_map)
+    if not rules:
+        return definitions_code
+    try:
+        tree = ast.parse(definitions_code)
+    except SyntaxError as e:
+        print(f"  -> AVERTISSEMENT: Code non analysable ({e}). Patchs ignorés.")
+        return definitions_code
+
+    transformer = PatchTransformer(rules)
+    tree = ast.fix_missing_locations(transformer.visit(tree))
+    for rule in rules:
+        count = transformer.applied.get(_rule_label(rule), 0)
+        if count:
+            print(f"  -> Patch '{_rule_label(rule)}' appliqué {count} fois.")
+        else:
+            print(f"  -> AVERTISSEMENT: Le patch '{_rule_label(rule)}' n'a pas trouvé le code à remplacer.")
+    if not transformer.applied:
+        return definitions_code
+    return ast.unparse(tree)
+
 # ===============================================================
 # --- FONCTIONS UTILITAIRES ET HANDLERS API ---
 # ===============================================================
@@ -447,16 +1200,61 @@ def sanitize_title_for_variable(title):
     if sane and sane[0].isdigit(): sane = '_' + sane
     return sane or "unnamed_node"
 
+# Cache des sources : class_name -> (classe, mtime du fichier, hash du corps, corps JSON, corps gzip ou None)
+# get_node_source ne sert plus qu'aux clients externes : le frontend envoie le graphe et l'analyse est faite ici.
+NODE_SOURCE_CACHE = {}
+# En dessous de cette taille, la compression coûte plus qu'elle ne rapporte
+COMPRESSION_MIN_SIZE = 1024
+
+def _get_node_source_entry(class_name):
+    """Mémoïse la réponse de get_node_source tant que le fichier du module n'a pas changé."""
+    class_obj = NODE_CLASS_MAPPINGS[class_name]
+    source_file = inspect.getsourcefile(class_obj)
+    mtime = os.path.getmtime(source_file) if source_file and os.path.exists(source_file) else None
+
+    cached = NODE_SOURCE_CACHE.get(class_name)
+    # La classe est aussi comparée : un nœud réinstallé à chaud est un nouvel objet
+    if cached and cached[0] is class_obj and cached[1] == mtime:
+        return cached
+
+    body = json.dumps({"source_code": inspect.getsource(class_obj)}).encode('utf-8')
+    etag = hashlib.sha1(body).hexdigest()
+    gzipped = gzip.compress(body) if len(body) >= COMPRESSION_MIN_SIZE else None
+    entry = (class_obj, mtime, etag, body, gzipped)
+    NODE_SOURCE_CACHE[class_name] = entry
+    return entry
+
 async def get_node_source(request):
     class_name = request.rel_url.query.get('class_name', None)
     if not class_name or class_name not in NODE_CLASS_MAPPINGS:
         return web.json_response({"error": f"Classe '{class_name}' non trouvée."}, status=404)
     try:
-        source_code = inspect.getsource(NODE_CLASS_MAPPINGS[class_name])
-        return web.json_response({"source_code": source_code})
+        _, _, etag, body, gzipped = _get_node_source_entry(class_name)
     except:
         return web.json_response({"error": f"Impossible de lire le code source pour '{class_name}'."}, status=500)
 
+    # Un validateur fort diffère selon l'encodage : le corps gzip a son propre ETag
+    use_gzip = gzipped is not None and "gzip" in request.headers.get("Accept-Encoding", "")
+    etag = f'"{etag}-gz"' if use_gzip else f'"{etag}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if_none_match = request.headers.get("If-None-Match", "")
+    client_etags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    if etag in client_etags or "*" in client_etags:
+        return web.Response(status=304, headers=headers)
+
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        body = gzipped
+    return web.Response(body=body, content_type='application/json', headers=headers)
+
+async def analyze_subgraph_handler(request):
+    try:
+        data = await request.json()
+        subgraph = extract_subgraph_definition(data.get('subgraph', data), data.get('subgraphId'))
+        return web.json_response(analyze_subgraph(subgraph))
+    except Exception as e:
+        return web.json_response({"error": f"Erreur lors de l'analyse du subgraph: {e}"}, status=400)
+
 def _find_entry_points_from_execute(naive_code_body, resolver):
     """Analyse le code de la méthode execute pour trouver les classes instanciées."""
     entry_points = set()
@@ -531,7 +1329,7 @@ def build_final_dependency_graph(final_code):
         traceback.print_exc()
         return None # Retourner None pour signaler l'échec
 
-def remove_dead_code(definitions_code, final_dependency_graph, entry_points):
+def remove_dead_code(definitions_code, final_dependency_graph, entry_points, progress=None):
     print("--- Démarrage de l'élagage du code mort (v9 - Graphe Final) ---")
     try:
         tree = ast.parse(definitions_code)
@@ -577,282 +1375,611 @@ def remove_dead_code(definitions_code, final_dependency_graph, entry_points):
             kept_definitions_nodes.sort(key=lambda node: original_order.get(node.name, float('inf')))
             cleaned_code = "\n\n".join([ast.unparse(node) for node in kept_definitions_nodes])
             print(f"--- Élagage terminé. Conservé {len(kept_definitions_nodes)}/{len(all_definitions)} définitions. ---")
+            if progress:
+                progress.update("prune", kept=len(kept_definitions_nodes), total=len(all_definitions))
             return cleaned_code
         else:
             print("--- AVERTISSEMENT: ast.unparse non disponible (Python < 3.9). Élagage annulé. ---")
             return definitions_code
 
+    except CompileCancelled:
+        raise
     except Exception as e:
         print(f"--- ERREUR pendant l'élagage: {e}. Utilisation du code non nettoyé. ---")
         traceback.print_exc()
         return definitions_code
 
-async def generate_code_handler(request):
-    build_indexes()
-    
-    try:
-        data = await request.json()
-        
-        initial_classes_to_process = {node['class_name'] for node in data['executionOrder']}
-        
-        # Ligne corrigée : On récupère bien les deux valeurs retournées par le resolver
-        resolver = DependencyResolver(NODE_CLASS_MAPPINGS)
-        collected_imports, definitions_code = resolver.resolve(initial_classes_to_process)
-  
-        # ▼▼▼ PATCH POUR LA COLLISION 'Attention' ▼▼▼
-        # On cherche le nom de la version Nunchaku de 'Attention'
-        renamed_attention_class = None
-        if resolver.rename_map:
-            for key in resolver.rename_map.values():
-                if 'Attention' in key and 'nunchaku' in key:
-                    renamed_attention_class = key
-                    break
-    
-        if renamed_attention_class:
-            print("  -> Application du patch pour le conflit de nom 'Attention'.")
-            # On s'assure que le code de Nunchaku appelle bien sa propre version de Attention
-            definitions_code = definitions_code.replace("self.attn = Attention(", f"self.attn = {renamed_attention_class}(")
-        # ▲▲▲ FIN DU PATCH 'Attention' ▲▲▲
-
-        # ▼▼▼ APPLICATION DE LA RÈGLE SPÉCIALE "NUNCHAKU" (VERSION CORRIGÉE) ▼▼▼
-        # On cherche le nom de la classe de config qui a été renommée
-        renamed_config_class = None
-        if resolver.rename_map: # S'assurer que la map n'est pas vide
-            for key in resolver.rename_map.values():
-                if 'NunchakuQwenImage' in key and 'configs' in key:
-                    renamed_config_class = key
-                    break
+# Types d'input affichés comme widgets par le frontend (les listes sont des combos)
+WIDGET_INPUT_TYPES = {'INT', 'FLOAT', 'STRING', 'BOOLEAN', 'COMBO'}
+# Valeurs du widget "control_after_generate" que le frontend ajoute après certains INT
+CONTROL_AFTER_GENERATE_VALUES = {'fixed', 'increment', 'decrement', 'randomize'}
 
-        if renamed_config_class:
-            print("LOG: Application du patch final pour Nunchaku (avec gestion de l'indentation).")
-        
-            # 1. Le Pattern capture maintenant l'indentation du début de la ligne dans le groupe 1 (\s*)
-            code_incorrect_pattern = re.compile(r'^(\s*)model_config\s*=\s*NunchakuQwenImage\s*\(\s*\{.*?\}\s*\)', re.DOTALL | re.MULTILINE)
-        
-            # 2. Le Remplacement est une simple ligne, SANS indentation
-            code_correct = f"model_config = {renamed_config_class}({{'image_model': 'qwen_image', 'scale_shift': 0, 'rank': rank, 'precision': precision}})"
-        
-            # 3. On utilise une fonction de remplacement pour réappliquer l'indentation capturée
-            def perform_replacement(match):
-                indentation = match.group(1) # Récupère l'indentation originale (groupe 1)
-                return f"{indentation}{code_correct}"
-            definitions_code = definitions_code.replace("class NunchakuQwenImage(QwenImage):", 
-                                                    "class NunchakuQwenImage(comfy.model_base.QwenImage):", 1)
-            definitions_code = definitions_code.replace("super(QwenImage, self).__init__(",
-                                                    "super(comfy.model_base.QwenImage, self).__init__(", 1)                                        
-            definitions_code, count = re.subn(code_incorrect_pattern, perform_replacement, definitions_code, count=1)
-            print("  -> Application du patch pour l'import relatif 'model_base'.")
-            definitions_code = definitions_code.replace('model_base.NunchakuQwenImage', 'NunchakuQwenImage')
-            if count > 0:
-                print("  -> Patch d'indentation appliqué avec succès.")
-            else:
-                print("  -> AVERTISSEMENT: Le patch Nunchaku n'a pas trouvé le code à remplacer.")
+def map_widget_values(node_class, widget_values):
+    """
+    Associe les widgets_values d'un nœud aux noms de ses inputs widgets, dans l'ordre
+    required puis optional. Chaque widget consomme une valeur, même si son input est
+    relié ; la valeur "control_after_generate" qui suit un seed est sautée.
+    """
+    if isinstance(widget_values, dict):
+        return dict(widget_values)
+    input_types = node_class.INPUT_TYPES()
+    mapped = {}
+    value_idx = 0
+    for section in ('required', 'optional'):
+        for name, props in (input_types.get(section) or {}).items():
+            if value_idx >= len(widget_values):
+                return mapped
+            props = props if isinstance(props, (list, tuple)) else (props,)
+            input_type = props[0] if props else None
+            options = props[1] if len(props) > 1 and isinstance(props[1], dict) else {}
+            if not (isinstance(input_type, (list, tuple)) or input_type in WIDGET_INPUT_TYPES):
+                continue
+            mapped[name] = widget_values[value_idx]
+            value_idx += 1
+            has_control = options.get('control_after_generate') or (input_type == 'INT' and name in ('seed', 'noise_seed'))
+            if (has_control and value_idx < len(widget_values)
+                    and widget_values[value_idx] in CONTROL_AFTER_GENERATE_VALUES):
+                value_idx += 1
+    return mapped
+
+def compile_subgraph(data, progress=None):
+    """
+    Génère le code du nœud compilé. Fonction synchrone, exécutée hors de la boucle
+    asyncio pour que les messages de progression partent pendant la compilation.
+    Renvoie le code et la liste des noms coupés par le budget de résolution.
+    """
+    build_indexes(progress)
 
-        # ▲▲▲ FIN DU PATCH ▲▲▲
+    # Le frontend n'envoie plus que le graphe : l'analyse est faite ici
+    if 'subgraph' in data:
+        subgraph = extract_subgraph_definition(data['subgraph'], data.get('subgraphId'))
+        data.update(analyze_subgraph(subgraph))
+    
+    initial_classes_to_process = {node['class_name'] for node in data['executionOrder']}
+    
+    # Ligne corrigée : On récupère bien les deux valeurs retournées par le resolver
+    resolver = DependencyResolver(NODE_CLASS_MAPPINGS)
+    budget = ResolutionBudget(**parse_resolution_budget(data.get('budget')))
+    collected_imports, definitions_code = resolver.resolve(initial_classes_to_process, progress, budget)
+    if resolver.budget_cuts and progress:
+        progress.update("budget", cuts=resolver.budget_cuts)
+  
+    # Patchs des collisions de noms (Attention, NunchakuQwenImage, ...) : une seule passe AST
+    definitions_code = apply_patch_rules(definitions_code, resolver.rename_map)
 
   
-        sane_class_name = sanitize_title_for_variable(data['newClassName'])
-
-        # ▼▼▼ APPEL DE LA FONCTION DE NETTOYAGE ▼▼▼
-        # On nettoie le code APRES les patchs, mais AVANT l'assemblage final
-        #definitions_code = remove_dead_code(definitions_code, resolver.dependency_graph, sane_class_name, resolver.rename_map)
-        # ▲▲▲ FIN DE L'APPEL ▲▲▲
-
-        NOODLE_TYPES = {'IMAGE', 'MODEL', 'LATENT', 'CLIP', 'VAE', 'CONDITIONING'}
-        all_handled_inputs = set()
-        if 'internalLinks' not in data: data['internalLinks'] = []
-        if 'ioMap' not in data: data['ioMap'] = {'inputs': {}, 'outputs': {}}
-        if 'inputs' not in data['ioMap']: data['ioMap']['inputs'] = {}
-        for link in data['internalLinks']: all_handled_inputs.add(f"{link['target_id']}:{link['target_slot']}")
-        for inp in data['ioMap']['inputs'].values(): all_handled_inputs.add(f"{inp['targetNodeId']}:{inp['targetNodeSlot']}")
-        for node in data['executionOrder']:
-            node_class = NODE_CLASS_MAPPINGS.get(node['class_name'])
-            if not node_class: continue
-            try:
-                required_inputs = node_class.INPUT_TYPES().get('required', {})
-                for i, input_slot_info in enumerate(node.get('inputs', [])):
-                    input_name = input_slot_info.get('name')
-                    input_type = input_slot_info.get('type')
-                    if (input_name in required_inputs and
-                        f"{node['id']}:{i}" not in all_handled_inputs and
-                        input_type in NOODLE_TYPES):
-                        new_input_name = f"{sanitize_title_for_variable(node.get('title', ''))}_{input_name}"
-                        data['ioMap']['inputs'][new_input_name] = {'name': new_input_name, 'type': input_type, 'originalClassName': node.get('class_name'), 'originalInputName': input_name, 'targetNodeId': node.get('id'), 'targetNodeSlot': i}
-            except Exception: pass
+    sane_class_name = sanitize_title_for_variable(data['newClassName'])
+
+    # ▼▼▼ APPEL DE LA FONCTION DE NETTOYAGE ▼▼▼
+    # On nettoie le code APRES les patchs, mais AVANT l'assemblage final
+    #definitions_code = remove_dead_code(definitions_code, resolver.dependency_graph, sane_class_name, resolver.rename_map)
+    # ▲▲▲ FIN DE L'APPEL ▲▲▲
+
+    NOODLE_TYPES = {'IMAGE', 'MODEL', 'LATENT', 'CLIP', 'VAE', 'CONDITIONING'}
+    all_handled_inputs = set()
+    if 'internalLinks' not in data: data['internalLinks'] = []
+    if 'ioMap' not in data: data['ioMap'] = {'inputs': {}, 'outputs': {}}
+    if 'inputs' not in data['ioMap']: data['ioMap']['inputs'] = {}
+    for link in data['internalLinks']: all_handled_inputs.add(f"{link['target_id']}:{link['target_slot']}")
+    for inp in data['ioMap']['inputs'].values(): all_handled_inputs.add(f"{inp['targetNodeId']}:{inp['targetNodeSlot']}")
+    for node in data['executionOrder']:
+        node_class = NODE_CLASS_MAPPINGS.get(node['class_name'])
+        if not node_class: continue
+        try:
+            required_inputs = node_class.INPUT_TYPES().get('required', {})
+            for i, input_slot_info in enumerate(node.get('inputs', [])):
+                input_name = input_slot_info.get('name')
+                input_type = input_slot_info.get('type')
+                if (input_name in required_inputs and
+                    f"{node['id']}:{i}" not in all_handled_inputs and
+                    input_type in NOODLE_TYPES):
+                    new_input_name = f"{sanitize_title_for_variable(node.get('title', ''))}_{input_name}"
+                    data['ioMap']['inputs'][new_input_name] = {'name': new_input_name, 'type': input_type, 'originalClassName': node.get('class_name'), 'originalInputName': input_name, 'targetNodeId': node.get('id'), 'targetNodeSlot': i}
+        except Exception: pass
 
-        base_imports = {"import logging", "logger = logging.getLogger(__name__)", "import torch", "import folder_paths", "from comfy import utils", "from comfy_api.latest import io", "import math", "import node_helpers"}
-        final_imports_set = base_imports.union(collected_imports)
+    base_imports = {"import logging", "logger = logging.getLogger(__name__)", "import torch", "import folder_paths", "from comfy import utils", "from comfy_api.latest import io", "import math", "import node_helpers"}
+    final_imports_set = base_imports.union(collected_imports)
 
-        # Le bloc de code bogué qui utilisait 'collected_code' a été supprimé.
+    # Le bloc de code bogué qui utilisait 'collected_code' a été supprimé.
 
-        body_code_parts = []
-        body_code_parts.append(f"class {sane_class_name}:")
-        body_code_parts.append("    @classmethod")
-        body_code_parts.append("    def INPUT_TYPES(s):")
-        body_code_parts.append("        return { \"required\": {")
-        io_inputs = data.get('ioMap', {}).get('inputs', {})
-        for name, details in io_inputs.items():
-          # ==================================================================
+    body_code_parts = []
+    body_code_parts.append(f"class {sane_class_name}:")
+    body_code_parts.append("    @classmethod")
+    body_code_parts.append("    def INPUT_TYPES(s):")
+    body_code_parts.append("        return { \"required\": {")
+    io_inputs = data.get('ioMap', {}).get('inputs', {})
+    for name, details in io_inputs.items():
+      # ==================================================================
 # == VERSION ULTIME DU BLOC try/except ==
 # ==================================================================
-          try:
-              original_class_name = details.get('originalClassName', '')
-              original_input_name = details.get('originalInputName', '')
-
-              # ÉTAPE 1: Analyse AST pour type dynamique
-              type_info_str = get_dynamic_input_str_from_source(original_class_name, original_input_name)
-
-              # ÉTAPE 2: Récupération des infos complètes du nœud
-              input_info = None
-              node_class = NODE_CLASS_MAPPINGS.get(original_class_name)
-              if node_class:
-                  try:
-                      input_defs = node_class.INPUT_TYPES()
-                      input_info = input_defs.get('required', {}).get(original_input_name)
-                  except:
-                      pass
-
-              # ÉTAPE 3: Fallback si l'analyse AST a échoué
-              if type_info_str is None:
-                  if input_info and isinstance(input_info[0], list):
-                      type_info_str = repr(input_info[0])
-                  else:
-                      type_info_str = f'"{details.get("type", "*")}"'
-
-              # ÉTAPE 4: Construction propre du tuple final
-              tuple_parts = [type_info_str]
-              if input_info and len(input_info) > 1:
-                  tuple_parts.append(repr(input_info[1]))
-
-              final_tuple_content = ", ".join(tuple_parts)
-              if len(tuple_parts) == 1:
-                  final_tuple_content += ","
-
-              # ▼▼▼ LA CORRECTION FINALE EST ICI ▼▼▼
-              # On remplace les appels spécifiques qui dépendent du contexte de leur classe d'origine.
-              final_tuple_content = final_tuple_content.replace('s.vae_list()', "folder_paths.get_filename_list('vae')")
-
-              body_code_parts.append(f"            \"{name}\": ({final_tuple_content}),")
-          
-          except Exception:
-              body_code_parts.append(f"            \"{name}\": (\"*\",),")
-        
-        body_code_parts.append("        }}")
+      try:
+          original_class_name = details.get('originalClassName', '')
+          original_input_name = details.get('originalInputName', '')
+
+          # ÉTAPE 1: Analyse AST pour type dynamique
+          type_info_str = get_dynamic_input_str_from_source(original_class_name, original_input_name)
+
+          # ÉTAPE 2: Récupération des infos complètes du nœud
+          input_info = None
+          node_class = NODE_CLASS_MAPPINGS.get(original_class_name)
+          if node_class:
+              try:
+                  input_defs = node_class.INPUT_TYPES()
+                  input_info = input_defs.get('required', {}).get(original_input_name)
+              except:
+                  pass
+
+          # ÉTAPE 3: Fallback si l'analyse AST a échoué
+          if type_info_str is None:
+              if input_info and isinstance(input_info[0], list):
+                  type_info_str = repr(input_info[0])
+              else:
+                  type_info_str = f'"{details.get("type", "*")}"'
+
+          # ÉTAPE 4: Construction propre du tuple final
+          tuple_parts = [type_info_str]
+          if input_info and len(input_info) > 1:
+              tuple_parts.append(repr(input_info[1]))
+
+          final_tuple_content = ", ".join(tuple_parts)
+          if len(tuple_parts) == 1:
+              final_tuple_content += ","
+
+          # ▼▼▼ LA CORRECTION FINALE EST ICI ▼▼▼
+          # On remplace les appels spécifiques qui dépendent du contexte de leur classe d'origine.
+          final_tuple_content = final_tuple_content.replace('s.vae_list()', "folder_paths.get_filename_list('vae')")
+
+          body_code_parts.append(f"            \"{name}\": ({final_tuple_content}),")
+      
+      except Exception:
+          body_code_parts.append(f"            \"{name}\": (\"*\",),")
+    
+    body_code_parts.append("        }}")
 
-        outputs = data.get('ioMap', {}).get('outputs', {}).values()
-        body_code_parts.append(f"    RETURN_TYPES = ({', '.join([f'\"{o.get("type", "UNKNOWN")}\"' for o in outputs])},)")
-        body_code_parts.append(f"    RETURN_NAMES = ({', '.join([f'\"{n.get("name", "unknown")}\"' for n in outputs])},)")
-        body_code_parts.append(f"    FUNCTION = \"execute\"")
-        body_code_parts.append(f"    CATEGORY = \"{data.get('newCategory', 'Subgraph')}\"")
+    outputs = data.get('ioMap', {}).get('outputs', {}).values()
+    body_code_parts.append(f"    RETURN_TYPES = ({', '.join([f'\"{o.get("type", "UNKNOWN")}\"' for o in outputs])},)")
+    body_code_parts.append(f"    RETURN_NAMES = ({', '.join([f'\"{n.get("name", "unknown")}\"' for n in outputs])},)")
+    body_code_parts.append(f"    FUNCTION = \"execute\"")
+    body_code_parts.append(f"    CATEGORY = \"{data.get('newCategory', 'Subgraph')}\"")
+    
+    input_keys = list(io_inputs.keys())
+    body_code_parts.append(f"\n    def execute(self, {', '.join(input_keys)}):")
+    
+    output_vars = {}
+    for node in data.get('executionOrder', []):
+        instance_name = f"{sanitize_title_for_variable(node.get('title', ''))}_{node.get('id', '')}"
+        node_class_name = node.get('class_name')
+        if not node_class_name: continue
         
-        input_keys = list(io_inputs.keys())
-        body_code_parts.append(f"\n    def execute(self, {', '.join(input_keys)}):")
+        node_class = NODE_CLASS_MAPPINGS.get(node_class_name)
+        function_name = node_class.FUNCTION
         
-        output_vars = {}
-        for node in data.get('executionOrder', []):
-            instance_name = f"{sanitize_title_for_variable(node.get('title', ''))}_{node.get('id', '')}"
-            node_class_name = node.get('class_name')
-            if not node_class_name: continue
-            
-            node_class = NODE_CLASS_MAPPINGS.get(node_class_name)
-            function_name = node_class.FUNCTION
-            
-            body_code_parts.append(f"\n        {instance_name} = {node_class_name}()")
-            
-            args = {}
-            
-            internal_links_for_node = [l for l in data.get('internalLinks', []) if l.get('target_id') == node.get('id')]
-            for link in internal_links_for_node:
-                if link.get('target_slot') is not None and link['target_slot'] < len(node.get('inputs', [])):
-                    arg_name = node['inputs'][link['target_slot']]['name']
-                    origin_node_id, origin_slot = link.get('origin_id'), link.get('origin_slot')
-                    if origin_node_id in output_vars and origin_slot < len(output_vars[origin_node_id]):
-                        args[arg_name] = output_vars[origin_node_id][origin_slot]
-            
-            exposed_inputs_for_node = [inp for inp in io_inputs.values() if inp.get('targetNodeId') == node.get('id')]
-            for inp in exposed_inputs_for_node:
-                if inp.get('targetNodeSlot') is not None and inp['targetNodeSlot'] < len(node.get('inputs', [])):
-                    original_arg_name = node['inputs'][inp['targetNodeSlot']]['name']
-                    args[original_arg_name] = inp['name']
-            
-            widget_values = node.get("widgets_values", [])
-            if widget_values:
-                try:
-                    original_inputs = node_class.INPUT_TYPES().get("required", {})
-                    widget_names = [name for name, props in original_inputs.items() if props[0] not in NOODLE_TYPES]
-                    
-                    value_idx = 0
-                    for name in widget_names:
-                         if name not in args and value_idx < len(widget_values):
-                             args[name] = widget_values[value_idx]
-                             value_idx += 1
-                except:
-                    pass
-            
-            args_parts = []
-            for k, v in args.items():
-                if isinstance(v, str) and (v in input_keys or v.startswith('out_')):
-                    args_parts.append(f"{k}={v}")
-                else:
-                    args_parts.append(f"{k}={repr(v)}")
-            args_str = ", ".join(args_parts)
-
-            return_vars = [f"out_{node.get('id', '')}_{i}" for i in range(len(node.get('outputs',[])))]
-            output_vars[node.get('id', '')] = return_vars
-
-            if return_vars:
-                body_code_parts.append(f"        ({', '.join(return_vars)},) = {instance_name}.{function_name}({args_str})")
-            else:
-                body_code_parts.append(f"        {instance_name}.{function_name}({args_str})")
-
-        final_return_vars = [output_vars[out['originNodeId']][out['originNodeSlot']] for out in outputs if out.get('originNodeId') in output_vars]
-        body_code_parts.append(f"\n        return ({', '.join(final_return_vars)},)")
+        body_code_parts.append(f"\n        {instance_name} = {node_class_name}()")
         
-        naive_code_body = "\n".join(body_code_parts)
+        args = {}
         
+        internal_links_for_node = [l for l in data.get('internalLinks', []) if l.get('target_id') == node.get('id')]
+        for link in internal_links_for_node:
+            if link.get('target_slot') is not None and link['target_slot'] < len(node.get('inputs', [])):
+                arg_name = node['inputs'][link['target_slot']]['name']
+                origin_node_id, origin_slot = link.get('origin_id'), link.get('origin_slot')
+                if origin_node_id in output_vars and origin_slot < len(output_vars[origin_node_id]):
+                    args[arg_name] = output_vars[origin_node_id][origin_slot]
         
-        # ▼▼▼ AJOUT MINIMAL POUR L'ÉLAGAGE ▼▼▼
-        # 1. Trouver les points d'entrée en appelant la nouvelle fonction
-        entry_points = _find_entry_points_from_execute(naive_code_body, resolver)
-
-        # 2. Construire le graphe de dépendances FINAL à partir du code patché
-        final_graph = build_final_dependency_graph(definitions_code)
+        exposed_inputs_for_node = [inp for inp in io_inputs.values() if inp.get('targetNodeId') == node.get('id')]
+        for inp in exposed_inputs_for_node:
+            if inp.get('targetNodeSlot') is not None and inp['targetNodeSlot'] < len(node.get('inputs', [])):
+                original_arg_name = node['inputs'][inp['targetNodeSlot']]['name']
+                args[original_arg_name] = inp['name']
         
-        # 3. Appeler la fonction de nettoyage simplifiée avec le nouveau graphe
-        if entry_points and final_graph is not None:
-             # Important: On passe bien final_graph ici !
-            definitions_code = remove_dead_code(definitions_code, final_graph, entry_points)
-        else:
-            print("--- AVERTISSEMENT: Points d'entrée non trouvés ou erreur graphe final. Élagage annulé. ---")
-        # ▲▲▲ FIN DE LA NOUVELLE LOGIQUE ▲▲▲
+        widget_values = node.get("widgets_values", [])
+        if widget_values:
+            try:
+                # Les inputs reliés ou exposés gardent leur source ; les autres prennent la valeur du widget
+                for name, value in map_widget_values(node_class, widget_values).items():
+                    args.setdefault(name, value)
+            except Exception as e:
+                print(f"  -> AVERTISSEMENT: widgets_values ignorés pour le nœud {node.get('id')}: {e}")
         
-        final_future = sorted([imp for imp in final_imports_set if '__future__' in imp])
-        final_other = sorted([imp for imp in final_imports_set if '__future__' not in imp])
-        final_import_code = "\n".join(final_future + final_other)
-
-        final_code_output = (
-            f"# ---Don't use this file for build_indexes--- \n\n"
-            f"# Fichier généré par le Subgraph Compiler (vFinal)\n\n"
-            f"{final_import_code}\n\n"
-            f"# --- Définitions des classes et fonctions nécessaires ---\n"
-            f"{definitions_code}\n\n"
-            f"# --- Nœud principal du sous-graphe ---\n"
-            f"{naive_code_body}\n\n"
-            f"# --- Mappings pour ComfyUI ---\n"
-            f"NODE_CLASS_MAPPINGS = {{ \"{sane_class_name}\": {sane_class_name} }}\n"
-            f"NODE_DISPLAY_NAME_MAPPINGS = {{ \"{data.get('newClassName', sane_class_name)}\": \"{sane_class_name}\" }}\n"
+        args_parts = []
+        for k, v in args.items():
+            if isinstance(v, str) and (v in input_keys or v.startswith('out_')):
+                args_parts.append(f"{k}={v}")
+            else:
+                args_parts.append(f"{k}={repr(v)}")
+        args_str = ", ".join(args_parts)
+
+        return_vars = [f"out_{node.get('id', '')}_{i}" for i in range(len(node.get('outputs',[])))]
+        output_vars[node.get('id', '')] = return_vars
+
+        if return_vars:
+            body_code_parts.append(f"        ({', '.join(return_vars)},) = {instance_name}.{function_name}({args_str})")
+        else:
+            body_code_parts.append(f"        {instance_name}.{function_name}({args_str})")
+
+    final_return_vars = [output_vars[out['originNodeId']][out['originNodeSlot']] for out in outputs if out.get('originNodeId') in output_vars]
+    body_code_parts.append(f"\n        return ({', '.join(final_return_vars)},)")
+    
+    naive_code_body = "\n".join(body_code_parts)
+    
+    
+    # ▼▼▼ AJOUT MINIMAL POUR L'ÉLAGAGE ▼▼▼
+    # 1. Trouver les points d'entrée en appelant la nouvelle fonction
+    entry_points = _find_entry_points_from_execute(naive_code_body, resolver)
+
+    # 2. Construire le graphe de dépendances FINAL à partir du code patché
+    final_graph = build_final_dependency_graph(definitions_code)
+    
+    # 3. Appeler la fonction de nettoyage simplifiée avec le nouveau graphe
+    if entry_points and final_graph is not None:
+         # Important: On passe bien final_graph ici !
+        definitions_code = remove_dead_code(definitions_code, final_graph, entry_points, progress)
+    else:
+        print("--- AVERTISSEMENT: Points d'entrée non trouvés ou erreur graphe final. Élagage annulé. ---")
+    # ▲▲▲ FIN DE LA NOUVELLE LOGIQUE ▲▲▲
+    
+    final_future = sorted([imp for imp in final_imports_set if '__future__' in imp])
+    final_other = sorted([imp for imp in final_imports_set if '__future__' not in imp])
+    final_import_code = "\n".join(final_future + final_other)
+
+    if data.get('outputMode') == 'shared':
+        # Les définitions vont dans la bibliothèque partagée, le nœud ne fait que les importer
+        definitions_header = f"# --- Définitions importées depuis la bibliothèque partagée '{SHARED_PACKAGE}' ---"
+        shared_imports = write_shared_library(
+            definitions_code, resolver.definition_imports, base_imports | resolver.budget_imports
         )
-        return web.Response(text=final_code_output, content_type='text/plain')
+        definitions_code = f"{SHARED_PACKAGE_BOOTSTRAP}\n{shared_imports}"
+    else:
+        definitions_header = "# --- Définitions des classes et fonctions nécessaires ---"
+
+    budget_note = ""
+    if resolver.budget_cuts:
+        actions = {'import': "importé", 'inline': "intégré sans ses dépendances"}
+        cut_lines = "\n".join(f"#   {cut['name']} ({cut['module']}, {cut['reason']}) : {actions[cut['action']]}"
+                              for cut in resolver.budget_cuts)
+        budget_note = f"# Budget de résolution dépassé :\n{cut_lines}\n\n"
+
+    final_code_output = (
+        f"{GENERATED_FILE_HEADER} \n\n"
+        f"# Fichier généré par le Subgraph Compiler (vFinal)\n\n"
+        f"{budget_note}"
+        f"{final_import_code}\n\n"
+        f"{definitions_header}\n"
+        f"{definitions_code}\n\n"
+        f"# --- Nœud principal du sous-graphe ---\n"
+        f"{naive_code_body}\n\n"
+        f"# --- Mappings pour ComfyUI ---\n"
+        f"NODE_CLASS_MAPPINGS = {{ \"{sane_class_name}\": {sane_class_name} }}\n"
+        f"NODE_DISPLAY_NAME_MAPPINGS = {{ \"{sane_class_name}\": \"{data.get('newClassName', sane_class_name)}\" }}\n"
+    )
+    return final_code_output, resolver.budget_cuts
 
+async def generate_code_handler(request):
+    try:
+        data = await request.json()
     except Exception as e:
+        return web.Response(status=400, text=f"Requête invalide: {e}")
+    if not isinstance(data, dict):
+        return web.Response(status=400, text="Requête invalide: un objet JSON est attendu.")
+    if not isinstance(data.get('newClassName'), str) or not data['newClassName'].strip():
+        return web.Response(status=400, text="Requête invalide: 'newClassName' (chaîne non vide) attendu.")
+    for key in ('compileId', 'clientId'):
+        if data.get(key) is not None and not isinstance(data[key], str):
+            return web.Response(status=400, text=f"Requête invalide: '{key}' doit être une chaîne.")
+    try:
+        parse_resolution_budget(data.get('budget'))
+    except ValueError as e:
+        return web.Response(status=400, text=f"Requête invalide: {e}")
+
+    progress = CompileProgress(data.get('compileId'), data.get('clientId'))
+    if progress.compile_id is not None:
+        ACTIVE_COMPILES[progress.compile_id] = progress
+    try:
+        loop = asyncio.get_running_loop()
+        final_code_output, budget_cuts = await loop.run_in_executor(None, compile_subgraph, data, progress)
+        progress.emit("done", code=final_code_output, budget_cuts=budget_cuts)
+        code_id = remember_generated_code(data['newClassName'], final_code_output)
+        headers = {
+            "X-Subgraph-Compiler-Budget-Cuts": str(len(budget_cuts)),
+            "X-Subgraph-Compiler-Code-Id": code_id,
+        }
+        return web.Response(text=final_code_output, content_type='text/plain', headers=headers)
+
+    except CompileCancelled as e:
+        print(f"--- {e} ---")
+        progress.emit("cancelled")
+        return web.Response(status=409, text=str(e))
+    except Exception as e:
+        progress.emit("error", message=str(e))
         return web.Response(status=500, text=f"Erreur lors de la génération du code: {e}\n{traceback.format_exc()}")
+    finally:
+        ACTIVE_COMPILES.pop(progress.compile_id, None)
+
+async def cancel_compile_handler(request):
+    try:
+        data = await request.json()
+    except Exception as e:
+        return web.json_response({"error": f"Requête invalide: {e}"}, status=400)
+    compile_id = data.get('compileId') if isinstance(data, dict) else None
+    if not isinstance(compile_id, str):
+        return web.json_response({"error": "Requête invalide: 'compileId' (chaîne) attendu."}, status=400)
+    progress = ACTIVE_COMPILES.get(compile_id)
+    if not progress:
+        return web.json_response({"error": "Aucune compilation en cours avec cet identifiant."}, status=404)
+    progress.cancel()
+    return web.json_response({"cancelled": progress.compile_id})
+
+# ===============================================================
+# --- BIBLIOTHÈQUE PARTAGÉE (MODE "shared") ---
+# ===============================================================
+SHARED_PACKAGE = "subgraph_shared"
+SHARED_LIBRARY_DIR = os.path.join(COMPILED_NODES_DIR, "_shared")
+# Inséré dans chaque nœud compilé en mode "shared" : déclare le paquet qui pointe vers la bibliothèque
+SHARED_PACKAGE_BOOTSTRAP = (
+    "import sys, types\n"
+    f"if '{SHARED_PACKAGE}' not in sys.modules:\n"
+    f"    _shared_package = types.ModuleType('{SHARED_PACKAGE}')\n"
+    f"    _shared_package.__path__ = [{SHARED_LIBRARY_DIR!r}]\n"
+    f"    sys.modules['{SHARED_PACKAGE}'] = _shared_package\n"
+)
+
+def _strongly_connected_components(graph, order):
+    """Algorithme de Tarjan. Les composantes sortent dépendances en premier."""
+    index, lowlink = {}, {}
+    stack, on_stack = [], set()
+    components = []
+
+    def visit(name):
+        index[name] = lowlink[name] = len(index)
+        stack.append(name)
+        on_stack.add(name)
+        for dep in sorted(graph.get(name, ())):
+            if dep not in index:
+                visit(dep)
+                lowlink[name] = min(lowlink[name], lowlink[dep])
+            elif dep in on_stack:
+                lowlink[name] = min(lowlink[name], index[dep])
+        if lowlink[name] == index[name]:
+            component = []
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                component.append(member)
+                if member == name:
+                    break
+            components.append(component)
+
+    for name in order:
+        if name not in index:
+            visit(name)
+    return components
+
+def write_shared_library(definitions_code, definition_imports, common_imports=()):
+    """
+    Range les définitions dans des modules partagés adressés par leur contenu
+    (sgc_<hash>.py) et renvoie les imports à placer dans le nœud compilé.
+    Le hash couvre aussi les modules dont une définition dépend : deux versions
+    différentes d'une même classe ne partagent jamais un module.
+    L'en-tête d'un module ne vient que des imports du fichier source de ses
+    définitions (definition_imports) et d'imports fixes (common_imports) : il ne
+    dépend pas des autres nœuds de la compilation.
+    """
+    tree = ast.parse(definitions_code)
+    definitions = {node.name: node for node in tree.body if isinstance(node, (ast.ClassDef, ast.FunctionDef))}
+    order = {name: i for i, name in enumerate(definitions)}
+    graph = build_final_dependency_graph(definitions_code)
+    if graph is None:
+        raise ValueError("Impossible de construire le graphe des définitions pour la bibliothèque partagée.")
+
+    os.makedirs(SHARED_LIBRARY_DIR, exist_ok=True)
+    module_of = {}
+    node_imports = []
+    reused = 0
+    # Une composante fortement connexe par module : pas d'import circulaire entre modules partagés
+    for component in _strongly_connected_components(graph, list(definitions)):
+        component.sort(key=order.get)
+        code = "\n\n".join(ast.unparse(definitions[name]) for name in component)
+
+        deps_by_module = defaultdict(set)
+        for name in component:
+            for dep in graph.get(name, ()):
+                if dep not in component:
+                    deps_by_module[module_of[dep]].add(dep)
+
+        candidate_imports = set(common_imports)
+        for name in component:
+            candidate_imports |= definition_imports.get(name, set())
+        used_imports = filter_imports(candidate_imports, code)
+        if re.search(r'\blogger\b', code):
+            used_imports |= {"import logging", "logger = logging.getLogger(__name__)"}
+        header_lines = sorted(imp for imp in used_imports if '__future__' in imp)
+        header_lines += sorted(imp for imp in used_imports if '__future__' not in imp)
+        header_lines += [f"from {SHARED_PACKAGE}.{module} import {', '.join(sorted(names))}" for module, names in sorted(deps_by_module.items())]
+
+        body = ("\n".join(header_lines) + "\n\n" if header_lines else "") + code + "\n"
+        module_name = f"sgc_{hashlib.sha256(body.encode('utf-8')).hexdigest()[:16]}"
+        file_path = os.path.join(SHARED_LIBRARY_DIR, f"{module_name}.py")
+        if os.path.exists(file_path):
+            reused += 1
+        else:
+            # Fichier temporaire unique : deux compilations (threads ou processus) peuvent
+            # écrire le même module en même temps, le contenu est identique.
+            fd, tmp_path = tempfile.mkstemp(dir=SHARED_LIBRARY_DIR, prefix=f"{module_name}.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(f"{GENERATED_FILE_HEADER} \n\n{body}")
+                os.replace(tmp_path, file_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+        for name in component:
+            module_of[name] = module_name
+        node_imports.append(f"from {SHARED_PACKAGE}.{module_name} import {', '.join(component)}")
+
+    print(f"--- Bibliothèque partagée : {len(node_imports)} module(s), dont {reused} déjà présent(s). ---")
+    return "\n".join(node_imports)
+
+# ===============================================================
+# --- INSTALLATION À CHAUD DES NŒUDS COMPILÉS ---
+# ===============================================================
+# Clés enregistrées par chaque module compilé, pour retirer celles d'une version précédente
+INSTALLED_COMPILED_NODES = {}
+# Noms affichés de chaque module compilé : deux noms qui donnent le même module ne se remplacent pas
+INSTALLED_COMPILED_TITLES = {}
+# Les installations tournent dans des threads : vérification et enregistrement sont atomiques
+INSTALL_LOCK = threading.Lock()
+
+class CompiledNodeConflict(ValueError):
+    """Levée quand un nœud compilé remplacerait un nœud qui ne lui appartient pas."""
+# Seul du code produit par generate_code peut être installé : le client ne transmet
+# que l'identifiant opaque renvoyé avec le code, jamais le code lui-même.
+GENERATED_CODE_LIMIT = 32
+GENERATED_CODE = OrderedDict()
+GENERATED_CODE_LOCK = threading.Lock()
+
+def remember_generated_code(class_name, code):
+    code_id = secrets.token_urlsafe(16)
+    with GENERATED_CODE_LOCK:
+        GENERATED_CODE[code_id] = (class_name, code)
+        while len(GENERATED_CODE) > GENERATED_CODE_LIMIT:
+            GENERATED_CODE.popitem(last=False)
+    return code_id
+
+def get_generated_code(code_id):
+    with GENERATED_CODE_LOCK:
+        return GENERATED_CODE.get(code_id)
+
+def _compiled_module_mappings(module_name, module):
+    class_mappings = getattr(module, 'NODE_CLASS_MAPPINGS', None)
+    if not isinstance(class_mappings, dict) or not class_mappings:
+        raise ValueError(f"Le module '{module_name}' ne définit aucun NODE_CLASS_MAPPINGS.")
+    display_mappings = getattr(module, 'NODE_DISPLAY_NAME_MAPPINGS', {}) or {}
+    return class_mappings, display_mappings
+
+def _compiled_module_title(class_mappings, display_mappings):
+    return tuple(sorted(str(display_mappings.get(key, key)) for key in class_mappings))
+
+def _check_compiled_node_ownership(module_name, class_mappings, display_mappings):
+    """Un module compilé ne peut remplacer que ses propres nœuds (jamais un nœud du cœur ou d'un autre pack)."""
+    own_keys = INSTALLED_COMPILED_NODES.get(module_name, set())
+    foreign = sorted(key for key in class_mappings if key in NODE_CLASS_MAPPINGS and key not in own_keys)
+    if foreign:
+        raise CompiledNodeConflict(f"Nom(s) déjà utilisé(s) par un autre nœud: {foreign}. Choisissez un autre nom de classe.")
+    previous_title = INSTALLED_COMPILED_TITLES.get(module_name)
+    title = _compiled_module_title(class_mappings, display_mappings)
+    if previous_title is not None and previous_title != title:
+        raise CompiledNodeConflict(
+            f"Le module '{module_name}' appartient déjà au nœud {list(previous_title)} : "
+            f"{list(title)} donne le même nom de fichier. Choisissez un autre nom de classe."
+        )
+
+def _register_compiled_module(module_name, module):
+    class_mappings, display_mappings = _compiled_module_mappings(module_name, module)
+    _check_compiled_node_ownership(module_name, class_mappings, display_mappings)
+
+    previous_keys = INSTALLED_COMPILED_NODES.get(module_name, set())
+    for key in previous_keys:
+        NODE_DISPLAY_NAME_MAPPINGS.pop(key, None)
+        if key not in class_mappings:
+            NODE_CLASS_MAPPINGS.pop(key, None)
+
+    NODE_CLASS_MAPPINGS.update(class_mappings)
+    NODE_DISPLAY_NAME_MAPPINGS.update({k: v for k, v in display_mappings.items() if k in class_mappings})
+    sys.modules[module_name] = module
+    INSTALLED_COMPILED_NODES[module_name] = set(class_mappings)
+    INSTALLED_COMPILED_TITLES[module_name] = _compiled_module_title(class_mappings, display_mappings)
+    return sorted(class_mappings)
+
+def _exec_compiled_module(module_name, code, file_path):
+    module = types.ModuleType(module_name)
+    module.__file__ = file_path
+    exec(compile(code, file_path, 'exec'), module.__dict__)
+    return module
+
+def install_compiled_node(class_name, code):
+    """
+    Écrit le module généré dans COMPILED_NODES_DIR, l'importe dans le processus et
+    fusionne ses mappings dans le registre de ComfyUI. Le module est exécuté avant
+    d'être écrit : en cas d'erreur ou de conflit, la version précédente reste en place.
+    """
+    with INSTALL_LOCK:
+        return _install_compiled_node_locked(class_name, code)
+
+def _install_compiled_node_locked(class_name, code):
+    sane_name = sanitize_title_for_variable(class_name)
+    if not code.lstrip().startswith(GENERATED_FILE_HEADER):
+        code = f"{GENERATED_FILE_HEADER} \n\n{code}"
+
+    os.makedirs(COMPILED_NODES_DIR, exist_ok=True)
+    file_path = os.path.join(COMPILED_NODES_DIR, f"{sane_name}.py")
+    module_name = f"{COMPILED_MODULE_PREFIX}{sane_name}"
+
+    module = _exec_compiled_module(module_name, code, file_path)
+    # Vérifié avant l'écriture : un conflit ne doit rien laisser sur disque
+    _check_compiled_node_ownership(module_name, *_compiled_module_mappings(module_name, module))
+
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(code)
+    os.replace(tmp_path, file_path)
+
+    replaced = module_name in INSTALLED_COMPILED_NODES
+    registered = _register_compiled_module(module_name, module)
+    print(f"--- Subgraph Compiler: '{module_name}' {'remplacé' if replaced else 'installé'} ({', '.join(registered)}). ---")
+    return {"path": file_path, "nodes": registered, "replaced": replaced}
+
+def load_compiled_nodes():
+    """Recharge au démarrage les nœuds déjà installés dans COMPILED_NODES_DIR."""
+    if not os.path.isdir(COMPILED_NODES_DIR):
+        return
+    for file in sorted(os.listdir(COMPILED_NODES_DIR)):
+        if not file.endswith('.py'):
+            continue
+        file_path = os.path.join(COMPILED_NODES_DIR, file)
+        module_name = f"{COMPILED_MODULE_PREFIX}{os.path.splitext(file)[0]}"
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                code = f.read()
+            _register_compiled_module(module_name, _exec_compiled_module(module_name, code, file_path))
+            print(f"  -> Nœud compilé chargé : {file_path}")
+        except Exception as e:
+            print(f"  -> ERREUR lors du chargement de '{file_path}': {e}")
+
+async def install_node_handler(request):
+    try:
+        data = await request.json()
+    except Exception as e:
+        return web.json_response({"error": f"Requête invalide: {e}"}, status=400)
+
+    code_id = data.get('codeId') if isinstance(data, dict) else None
+    if not isinstance(code_id, str):
+        return web.json_response({"error": "Requête invalide: 'codeId' (chaîne) attendu."}, status=400)
+    generated = get_generated_code(code_id)
+    if generated is None:
+        return web.json_response({"error": "Code inconnu ou expiré : recompilez le subgraph avant de l'installer."}, status=404)
+
+    try:
+        # L'import du module peut être long (torch, etc.) : hors de la boucle aiohttp
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, install_compiled_node, *generated)
+        return web.json_response(result)
+    except CompiledNodeConflict as e:
+        return web.json_response({"error": str(e)}, status=409)
+    except Exception as e:
+        return web.json_response({"error": f"Erreur lors de l'installation du nœud: {e}", "traceback": traceback.format_exc()}, status=500)
 
 # ===============================================================
 # --- ENREGISTREMENT DES ROUTES API ---
 # ===============================================================
 def add_api_routes(app):
     print("✅ Ajout des routes API pour le Subgraph Compiler...")
+    load_user_patch_rules()
     app.add_routes([
         web.get('/subgraph_compiler/get_node_source', get_node_source),
-        web.post('/subgraph_compiler/generate_code', generate_code_handler)
+        web.post('/subgraph_compiler/analyze', analyze_subgraph_handler),
+        web.post('/subgraph_compiler/generate_code', generate_code_handler),
+        web.post('/subgraph_compiler/cancel', cancel_compile_handler),
+        web.post('/subgraph_compiler/install', install_node_handler)
     ])
\ No newline at end of file
@@ -0,0 +1,400 @@
+"""
+Banc d'essai des nœuds générés par le Subgraph Compiler.
+
+Importe un fichier généré dans un sous-processus isolé et mesure :
+  - le temps d'import des dépendances et du module lui-même,
+  - le nombre de définitions embarquées (ou importées depuis la bibliothèque partagée),
+  - la mémoire résidente avant/après l'import,
+puis exécute `execute` avec de petites entrées synthétiques en chronométrant
+chaque appel aux nœuds internes. L'exécution se fait sur CPU sauf avec --gpu.
+
+Exemples :
+  python benchmark.py mon_noeud.py --comfy-root ~/ComfyUI
+  python benchmark.py mon_noeud.py --stub
+  python benchmark.py --workflow wf_exemple/subgraph_Qwen.json --server http://127.0.0.1:8188 \\
+      --comfy-root ~/ComfyUI --history bench_history.jsonl
+"""
+import argparse
+import ast
+import datetime
+import hashlib
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import inspect
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import urllib.request
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+SHARED_PACKAGE = "subgraph_shared"
+
+# ===============================================================
+# --- DÉPENDANCES FACTICES (MODE --stub) ---
+# ===============================================================
+class _StubMeta(type):
+    """Métaclasse des classes factices : tout attribut manquant est une autre classe factice."""
+    def __getattr__(cls, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _stub_class(f"{cls.__name__}.{name}")
+
+    def __call__(cls, *args, **kwargs):
+        # Utilisée comme décorateur sans parenthèses : on rend la fonction intacte
+        if cls.__dict__.get('_is_stub') and len(args) == 1 and not kwargs and callable(args[0]):
+            return args[0]
+        return super().__call__(*args, **kwargs)
+
+class _StubObject(metaclass=_StubMeta):
+    _is_stub = True
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _stub_class(name)
+
+    def __call__(self, *args, **kwargs):
+        if len(args) == 1 and not kwargs and callable(args[0]):
+            return args[0]
+        return self
+
+    def __getitem__(self, key):
+        return self
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self):
+        return 0
+
+def _stub_class(name):
+    return _StubMeta(name.rsplit('.', 1)[-1], (_StubObject,), {'_is_stub': True})
+
+class _StubModule(types.ModuleType):
+    def __init__(self, name):
+        super().__init__(name)
+        self.__path__ = []
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _stub_class(f"{self.__name__}.{name}")
+
+class _StubFinder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """Placé en fin de sys.meta_path : ne fournit que les modules introuvables."""
+    def __init__(self):
+        self.stubbed = []
+
+    def find_spec(self, fullname, path, target=None):
+        return importlib.machinery.ModuleSpec(fullname, self, is_package=True)
+
+    def create_module(self, spec):
+        self.stubbed.append(spec.name)
+        return _StubModule(spec.name)
+
+    def exec_module(self, module):
+        pass
+
+# ===============================================================
+# --- MESURES (SOUS-PROCESSUS) ---
+# ===============================================================
+def _current_rss_kb():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss // 1024
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _count_definitions(tree):
+    definitions = [n for n in tree.body if isinstance(n, (ast.ClassDef, ast.FunctionDef))]
+    shared = [
+        alias.name for n in tree.body
+        if isinstance(n, ast.ImportFrom) and n.module and n.module.startswith(SHARED_PACKAGE + '.')
+        for alias in n.names
+    ]
+    return len(definitions), len(shared)
+
+def _dependency_imports(tree):
+    """Les imports de premier niveau du fichier, pour les chronométrer séparément."""
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            if not node.module.startswith(SHARED_PACKAGE):
+                modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+def _synthetic_value(type_info, torch):
+    input_type = type_info[0]
+    options = type_info[1] if len(type_info) > 1 and isinstance(type_info[1], dict) else {}
+    if isinstance(input_type, (list, tuple)):
+        return input_type[0] if input_type else ""
+    if 'default' in options:
+        return options['default']
+    if input_type == "INT":
+        return options.get('min', 0)
+    if input_type == "FLOAT":
+        return options.get('min', 0.0)
+    if input_type == "STRING":
+        return ""
+    if input_type == "BOOLEAN":
+        return False
+    if torch is None:
+        return None
+    if input_type == "IMAGE":
+        return torch.zeros(1, 64, 64, 3)
+    if input_type == "MASK":
+        return torch.zeros(1, 64, 64)
+    if input_type == "LATENT":
+        return {"samples": torch.zeros(1, 4, 8, 8)}
+    # MODEL, CLIP, VAE, CONDITIONING... : impossibles à fabriquer sans poids
+    return None
+
+def _instrument_node_classes(module, compiled_cls, timings):
+    """Enveloppe la méthode FUNCTION de chaque nœud interne pour chronométrer ses appels."""
+    def timed(name, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.append({"node": name, "seconds": time.perf_counter() - start})
+        return wrapper
+
+    for name, obj in list(vars(module).items()):
+        if not isinstance(obj, type) or obj is compiled_cls:
+            continue
+        function_name = obj.__dict__.get('FUNCTION') or getattr(obj, 'FUNCTION', None)
+        if not isinstance(function_name, str):
+            continue
+        try:
+            raw = inspect.getattr_static(obj, function_name)
+        except AttributeError:
+            continue
+        if isinstance(raw, classmethod):
+            setattr(obj, function_name, classmethod(timed(name, raw.__func__)))
+        elif isinstance(raw, staticmethod):
+            setattr(obj, function_name, staticmethod(timed(name, raw.__func__)))
+        elif callable(raw):
+            setattr(obj, function_name, timed(name, raw))
+
+def run_child(file_path, comfy_root, stub, run_execute):
+    """Point d'entrée du sous-processus : renvoie les mesures sous forme de dict."""
+    if comfy_root:
+        sys.path.insert(0, comfy_root)
+    # comfy.cli_args lit sys.argv à l'import
+    sys.argv = [sys.argv[0], '--cpu'] if os.environ.get('CUDA_VISIBLE_DEVICES') == '' else [sys.argv[0]]
+    stub_finder = None
+    if stub:
+        stub_finder = _StubFinder()
+        sys.meta_path.append(stub_finder)
+
+    with open(file_path, 'r', encoding='utf-8') as f:
+        source = f.read()
+    tree = ast.parse(source)
+    inline_definitions, shared_definitions = _count_definitions(tree)
+
+    result = {"definitions": inline_definitions, "shared_definitions": shared_definitions}
+    rss_start = _current_rss_kb()
+
+    start = time.perf_counter()
+    failed_dependencies = {}
+    for module_name in _dependency_imports(tree):
+        try:
+            importlib.import_module(module_name)
+        except Exception as e:
+            failed_dependencies[module_name] = repr(e)
+    result["dependency_import_seconds"] = time.perf_counter() - start
+    rss_after_deps = _current_rss_kb()
+
+    start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location("benchmarked_node", file_path)
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except Exception as e:
+        module = None
+        result["module_import_error"] = f"{type(e).__name__}: {e}"
+    result["module_import_seconds"] = time.perf_counter() - start
+    rss_after_module = _current_rss_kb()
+
+    result["rss_kb"] = {"start": rss_start, "after_dependencies": rss_after_deps, "after_module": rss_after_module}
+    if failed_dependencies:
+        result["failed_dependencies"] = failed_dependencies
+    if stub_finder:
+        result["stubbed_modules"] = sorted({name.split('.')[0] for name in stub_finder.stubbed})
+
+    if run_execute and module is not None:
+        result["execute"] = _run_execute(module)
+    return result
+
+def _run_execute(module):
+    try:
+        import torch
+        if isinstance(torch, _StubModule):
+            torch = None
+    except ImportError:
+        torch = None
+
+    compiled_cls = next(iter(module.NODE_CLASS_MAPPINGS.values()))
+    timings = []
+    _instrument_node_classes(module, compiled_cls, timings)
+
+    report = {"node_calls": timings}
+    try:
+        required = compiled_cls.INPUT_TYPES().get("required", {})
+        inputs = {name: _synthetic_value(info, torch) for name, info in required.items()}
+        report["missing_inputs"] = sorted(name for name, value in inputs.items() if value is None)
+
+        start = time.perf_counter()
+        if torch is not None:
+            with torch.inference_mode():
+                getattr(compiled_cls(), compiled_cls.FUNCTION)(**inputs)
+        else:
+            getattr(compiled_cls(), compiled_cls.FUNCTION)(**inputs)
+        report["total_seconds"] = time.perf_counter() - start
+    except Exception as e:
+        report["error"] = f"{type(e).__name__}: {e}"
+    return report
+
+# ===============================================================
+# --- PROCESSUS PARENT ---
+# ===============================================================
+def compile_workflow(server_url, workflow_path, output_mode):
+    """Compile un workflow (ex: wf_exemple/*.json) via le serveur ComfyUI en marche."""
+    with open(workflow_path, 'r', encoding='utf-8') as f:
+        workflow = json.load(f)
+    class_name = os.path.splitext(os.path.basename(workflow_path))[0]
+    payload = {"newClassName": class_name, "newCategory": "benchmark", "subgraph": workflow, "outputMode": output_mode}
+    request = urllib.request.Request(
+        f"{server_url.rstrip('/')}/subgraph_compiler/generate_code",
+        data=json.dumps(payload).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+    )
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        code = response.read().decode('utf-8')
+    return code, time.perf_counter() - start
+
+def _compiler_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def benchmark_file(file_path, comfy_root=None, stub=False, cpu=True, run_execute=True):
+    """Lance les mesures dans un sous-processus isolé et renvoie le rapport."""
+    env = dict(os.environ)
+    if cpu:
+        env['CUDA_VISIBLE_DEVICES'] = ''
+    command = [sys.executable, os.path.abspath(__file__), '--child', file_path]
+    if comfy_root:
+        command += ['--comfy-root', comfy_root]
+    if stub:
+        command.append('--stub')
+    if not run_execute:
+        command.append('--no-execute')
+
+    completed = subprocess.run(command, env=env, capture_output=True, text=True)
+    # Le nœud peut écrire sur stdout : le rapport est la dernière ligne
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or not lines:
+        raise RuntimeError(f"Le sous-processus a échoué ({completed.returncode}):\n{completed.stderr}")
+    return json.loads(lines[-1])
+
+def _print_report(record):
+    print(f"\n=== {record['file']} (compilateur {record['compiler_version']}) ===")
+    if 'compile_seconds' in record:
+        print(f"Compilation           : {record['compile_seconds']:.3f} s")
+    print(f"Définitions           : {record['definitions']} embarquées, {record['shared_definitions']} partagées")
+    print(f"Import dépendances    : {record['dependency_import_seconds']:.3f} s")
+    print(f"Import module         : {record['module_import_seconds']:.3f} s")
+    for module_name, error in record.get('failed_dependencies', {}).items():
+        print(f"  dépendance en échec : {module_name} ({error})")
+    if 'module_import_error' in record:
+        print(f"Import du module en échec : {record['module_import_error']}")
+    rss = record['rss_kb']
+    if rss['start'] is not None:
+        print(f"Mémoire résidente     : {rss['start']} -> {rss['after_dependencies']} -> {rss['after_module']} Ko")
+    if record.get('stubbed_modules'):
+        print(f"Modules factices      : {', '.join(record['stubbed_modules'])}")
+    execute = record.get('execute')
+    if execute:
+        for call in execute['node_calls']:
+            print(f"  {call['node']:<40} {call['seconds'] * 1000:10.2f} ms")
+        if 'total_seconds' in execute:
+            print(f"execute total         : {execute['total_seconds']:.3f} s")
+        if execute.get('missing_inputs'):
+            print(f"Entrées non synthétisées : {', '.join(execute['missing_inputs'])}")
+        if 'error' in execute:
+            print(f"execute interrompu    : {execute['error']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Banc d'essai des nœuds générés par le Subgraph Compiler.")
+    parser.add_argument('file', nargs='?', help="Fichier .py généré par generate_code.")
+    parser.add_argument('--workflow', action='append', default=[], help="Workflow à compiler via --server (répétable).")
+    parser.add_argument('--server', default="http://127.0.0.1:8188", help="URL du serveur ComfyUI pour --workflow.")
+    parser.add_argument('--output-mode', default="standalone", choices=["standalone", "shared"])
+    parser.add_argument('--comfy-root', help="Racine de ComfyUI, ajoutée au sys.path du sous-processus.")
+    parser.add_argument('--stub', action='store_true', help="Remplace les modules introuvables par des modules factices.")
+    parser.add_argument('--gpu', action='store_true', help="Ne force pas l'exécution sur CPU.")
+    parser.add_argument('--no-execute', action='store_true', help="Ne mesure que l'import.")
+    parser.add_argument('--history', help="Fichier JSONL auquel ajouter les résultats.")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.file, args.comfy_root, args.stub, not args.no_execute)))
+        return
+
+    targets = []
+    if args.file:
+        targets.append((args.file, None))
+    for workflow_path in args.workflow:
+        code, compile_seconds = compile_workflow(args.server, workflow_path, args.output_mode)
+        fd, generated_path = tempfile.mkstemp(prefix=os.path.splitext(os.path.basename(workflow_path))[0] + '_', suffix='.py')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(code)
+        targets.append((generated_path, {"workflow": workflow_path, "compile_seconds": compile_seconds}))
+    if not targets:
+        parser.error("Indiquer un fichier généré ou au moins un --workflow.")
+
+    version = _compiler_version()
+    for file_path, extra in targets:
+        with open(file_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        record = {
+            "file": extra["workflow"] if extra else file_path,
+            "sha256": digest,
+            "compiler_version": version,
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "python": sys.version.split()[0],
+            "mode": "stub" if args.stub else ("gpu" if args.gpu else "cpu"),
+            **(extra or {}),
+            **benchmark_file(file_path, args.comfy_root, args.stub, not args.gpu, not args.no_execute),
+        }
+        _print_report(record)
+        if args.history:
+            with open(args.history, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import { app } from "/scripts/app.js";
+import { api } from "/scripts/api.js";
 
 function isNodeSubgraph(node) {
     if (!node || !node.type || typeof node.type !== 'string') return false;
@@ -6,68 +7,56 @@ function isNodeSubgraph(node) {
     return uuidRegex.test(node.type);
 }
 
-function analyzeSubgraph(subgraphNode) {
+function serializeSubgraph(subgraphNode) {
+    // Le backend se charge de l'analyse (ioMap, liens, ordre d'exécution) :
+    // on se contente d'envoyer une copie nettoyée du graphe interne.
     const internalGraph = subgraphNode.subgraph;
     if (!internalGraph) return null;
 
     const nodes = Object.values(internalGraph._nodes_by_id || {});
     const links = Array.from((internalGraph.links || new Map()).values());
-    const nodeIds = new Set(nodes.map(n => n.id));
-
-    const ioMap = { inputs: {}, outputs: {} };
-
-    const inputLinks = links.filter(l => l && !nodeIds.has(l.origin_id));
-    for (const link of inputLinks) {
-        const targetNode = internalGraph.getNodeById(link.target_id);
-        const inputOnParent = subgraphNode.inputs[link.origin_slot];
-        if (targetNode && inputOnParent) {
-            const originalInputSlot = targetNode.inputs[link.target_slot];
-            ioMap.inputs[inputOnParent.name] = { 
-                name: inputOnParent.name, 
-                type: inputOnParent.type,
-                targetNodeId: link.target_id, 
-                targetNodeSlot: link.target_slot,
-                originalClassName: LiteGraph.getNodeType(targetNode.type).nodeData.name,
-                originalInputName: originalInputSlot.name,
-            };
-        }
-    }
-    
-    const outputLinks = links.filter(l => l && !nodeIds.has(l.target_id));
-    for (const link of outputLinks) {
-        const originNode = internalGraph.getNodeById(link.origin_id);
-        const outputOnParent = subgraphNode.outputs[link.target_slot];
-        if(originNode && outputOnParent) {
-            ioMap.outputs[outputOnParent.name] = { 
-                name: outputOnParent.name, 
-                type: outputOnParent.type, 
-                originNodeId: link.origin_id, 
-                originNodeSlot: link.origin_slot,
-            };
-        }
-    }
 
-    const executionOrder = [];
-    const internalLinks = links.filter(l => l && nodeIds.has(l.origin_id) && nodeIds.has(l.target_id));
-    const inDegree = new Map(nodes.map(n => [n.id, 0]));
-    for (const link of internalLinks) {
-        inDegree.set(link.target_id, inDegree.get(link.target_id) + 1);
-    }
-    
-    const queue = nodes.filter(n => inDegree.get(n.id) === 0);
-    while (queue.length > 0) {
-        const node = queue.shift();
-        executionOrder.push(node);
-        const outgoingLinks = internalLinks.filter(l => l && l.origin_id === node.id);
-        for (const link of outgoingLinks) {
-            inDegree.set(link.target_id, inDegree.get(link.target_id) - 1);
-            if (inDegree.get(link.target_id) === 0) {
-                const nextNode = internalGraph.getNodeById(link.target_id);
-                if (nextNode) queue.push(nextNode);
-            }
-        }
+    return {
+        id: subgraphNode.type,
+        inputs: subgraphNode.inputs.map(i => ({ name: i.name, type: i.type })),
+        outputs: subgraphNode.outputs.map(o => ({ name: o.name, type: o.type })),
+        nodes: nodes.map(node => ({
+            id: node.id,
+            title: node.title,
+            type: node.type,
+            class_name: LiteGraph.getNodeType(node.type)?.nodeData?.name,
+            inputs: (node.inputs || []).map(i => ({ name: i.name, type: i.type })),
+            outputs: (node.outputs || []).map(o => ({ name: o.name, type: o.type })),
+        })),
+        links: links.filter(l => l).map(l => ({
+            id: l.id,
+            origin_id: l.origin_id,
+            origin_slot: l.origin_slot,
+            target_id: l.target_id,
+            target_slot: l.target_slot,
+        })),
+    };
+}
+
+// crypto.randomUUID n'existe qu'en contexte sécurisé (HTTPS ou localhost) :
+// un serveur ouvert via http://<ip-lan>:8188 doit pouvoir compiler aussi.
+function newCompileId() {
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`;
+}
+
+function describeProgress(detail) {
+    switch (detail.stage) {
+        case "index":
+            return detail.cached ? "Index déjà construit." : `Construction de l'index : ${detail.percent}% (${detail.files} fichiers)...`;
+        case "resolve":
+            return `Résolution des dépendances : ${detail.resolved} noms résolus, ${detail.pending} en attente...`;
+        case "budget":
+            return `Budget de résolution dépassé : ${detail.cuts.length} nom(s) coupé(s)...`;
+        case "prune":
+            return `Élagage : ${detail.kept}/${detail.total} définitions conservées...`;
+        default:
+            return null;
     }
-    return { ioMap, executionOrder: executionOrder.filter(n => n.type !== "GraphInput" && n.type !== "GraphOutput") };
 }
 
 app.registerExtension({
@@ -82,6 +71,17 @@ app.registerExtension({
                 const categoryWidget = this.addWidget("STRING", "New Node Category", "_my_nodes/custom", {});
                 const statusWidget = this.addWidget("STRING", "Status", "Ready", {});
                 const codeWidget = this.widgets.find(w => w.name === "generated_code");
+                let activeCompileId = null;
+                let generatedCodeId = null;
+
+                // Retiré dans onRemoved : sinon chaque nœud supprimé laisse un écouteur actif
+                this.onCompileProgress = ({ detail }) => {
+                    if (!detail || detail.compile_id !== activeCompileId) return;
+                    const message = describeProgress(detail);
+                    if (message) statusWidget.value = message;
+                    app.graph.setDirtyCanvas(true, false);
+                };
+                api.addEventListener("subgraph_compiler_progress", this.onCompileProgress);
                 
  this.addWidget("button", "Compile Subgraph", null, async () => {
                     statusWidget.value = "Analyse en cours...";
@@ -98,66 +98,43 @@ app.registerExtension({
                         return;
                     }
 
-                    const analysis = analyzeSubgraph(connectedSubgraphNode);
-                    if(!analysis || !analysis.executionOrder) {
+                    const subgraph = serializeSubgraph(connectedSubgraphNode);
+                    if (!subgraph) {
                         statusWidget.value = "Erreur : L'analyse du graphe a échoué.";
                         return;
                     }
-                    
-                    statusWidget.value = `Récupération du code source (${analysis.executionOrder.length} nœuds)...`;
-                    await new Promise(r => setTimeout(r, 0));
-                    
-                    const nodeSources = {};
-                    for (const node of analysis.executionOrder) {
-                        try {
-                            const nodeTypeName = LiteGraph.getNodeType(node.type).nodeData.name;
-                            const response = await fetch(`/subgraph_compiler/get_node_source?class_name=${nodeTypeName}`);
-                            if (!response.ok) { throw new Error(`Erreur HTTP ${response.status}`); }
-                            const data = await response.json();
-                             if (data.error) { throw new Error(data.error); }
-                            nodeSources[node.id] = data;
-                        } catch(e) {
-                            statusWidget.value = `Erreur API pour ${node.title}: ${e.message}`;
-                            return;
-                        }
-                    }
 
-                    statusWidget.value = "Génération du code par le backend...";
-                    
-                    // --- CORRECTION : Nettoyage des objets avant l'envoi ---
-                     const sanitizedExecutionOrder = analysis.executionOrder.map(node => ({
-                        id: node.id,
-                        title: node.title,
-                        type: node.type,
-                        class_name: LiteGraph.getNodeType(node.type).nodeData.name,
-                        inputs: node.inputs.map(i => ({ name: i.name, type: i.type })),
-                        outputs: node.outputs.map(o => ({ name: o.name, type: o.type })),
-                    }));
-
-                    const sanitizedLinks = Array.from(connectedSubgraphNode.subgraph.links.values()).map(l => ({
-                        id: l.id,
-                        origin_id: l.origin_id,
-                        origin_slot: l.origin_slot,
-                        target_id: l.target_id,
-                        target_slot: l.target_slot,
-                    }));
+                    statusWidget.value = `Génération du code par le backend (${subgraph.nodes.length} nœuds)...`;
 
+                    const compileId = newCompileId();
+                    activeCompileId = compileId;
                     const payload = {
                         newClassName: classNameWidget.value,
                         newCategory: categoryWidget.value,
-                        ioMap: analysis.ioMap,
-                        executionOrder: sanitizedExecutionOrder, // On envoie la version nettoyée
-                        internalLinks: sanitizedLinks, // On envoie la version nettoyée
-                        nodeSources: nodeSources,
+                        subgraph: subgraph,
+                        outputMode: outputModeWidget.value,
+                        compileId: compileId,
+                        clientId: api.clientId,
                     };
-                    // --- FIN DE LA CORRECTION ---
-                    
-                    const genResponse = await fetch('/subgraph_compiler/generate_code', {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify(payload)
-                    });
                     
+                    let genResponse;
+                    try {
+                        genResponse = await fetch('/subgraph_compiler/generate_code', {
+                            method: 'POST',
+                            headers: { 'Content-Type': 'application/json' },
+                            body: JSON.stringify(payload)
+                        });
+                    } catch (error) {
+                        statusWidget.value = `Erreur réseau: ${error.message}`;
+                        return;
+                    } finally {
+                        if (activeCompileId === compileId) activeCompileId = null;
+                    }
+
+                    if (genResponse.status === 409) {
+                        statusWidget.value = "Compilation annulée.";
+                        return;
+                    }
                     if (!genResponse.ok) {
                         statusWidget.value = `Erreur Backend: ${await genResponse.text()}`;
                         return;
@@ -165,11 +142,15 @@ app.registerExtension({
                     
                     const finalCode = await genResponse.text();
                     codeWidget.value = finalCode;
-                    statusWidget.value = "✅ Succès ! Code généré.";
+                    generatedCodeId = genResponse.headers.get("X-Subgraph-Compiler-Code-Id");
+                    const budgetCuts = Number(genResponse.headers.get("X-Subgraph-Compiler-Budget-Cuts") || 0);
+                    statusWidget.value = budgetCuts
+                        ? `✅ Code généré (${budgetCuts} nom(s) coupé(s), budget de résolution dépassé).`
+                        : "✅ Succès ! Code généré.";
 
                     setTimeout(() => { this.computeSize(); app.graph.setDirtyCanvas(true, true); }, 0);
                 });
-                
+
                 this.addWidget("button", "Copy to Clipboard", null, () => {
                     if (codeWidget.value) {
                         navigator.clipboard.writeText(codeWidget.value).then(() => {
@@ -177,6 +158,54 @@ app.registerExtension({
                         }, () => { statusWidget.value = "Erreur lors de la copie."; });
                     }
                 });
+
+                // Widgets ajoutés après ceux d'origine : les widgets_values des workflows
+                // déjà sauvegardés gardent leurs indices.
+                const outputModeWidget = this.addWidget("combo", "Output Mode", "standalone", () => {}, { values: ["standalone", "shared"] });
+
+                this.addWidget("button", "Cancel Compile", null, async () => {
+                    if (!activeCompileId) return;
+                    statusWidget.value = "Annulation en cours...";
+                    await fetch('/subgraph_compiler/cancel', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify({ compileId: activeCompileId })
+                    });
+                });
+                
+                this.addWidget("button", "Install Node", null, async () => {
+                    // Le serveur n'installe que le code qu'il a lui-même généré, désigné par son identifiant
+                    if (!generatedCodeId) {
+                        statusWidget.value = "Erreur : compilez d'abord le subgraph.";
+                        return;
+                    }
+                    statusWidget.value = "Installation du nœud...";
+                    const response = await fetch('/subgraph_compiler/install', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify({ codeId: generatedCodeId })
+                    });
+                    const result = await response.json();
+                    if (!response.ok || result.error) {
+                        statusWidget.value = `Erreur d'installation: ${result.error}`;
+                        return;
+                    }
+
+                    // On enregistre les nouvelles définitions côté frontend, sans redémarrage
+                    const defs = await api.getNodeDefs();
+                    const installedDefs = Object.fromEntries(result.nodes.filter(n => defs[n]).map(n => [n, defs[n]]));
+                    await app.registerNodesFromDefs?.(installedDefs);
+                    statusWidget.value = `✅ Nœud ${result.replaced ? "remplacé" : "installé"} : ${result.nodes.join(", ")}`;
+                });
+            };
+
+            const onRemoved = nodeType.prototype.onRemoved;
+            nodeType.prototype.onRemoved = function () {
+                if (this.onCompileProgress) {
+                    api.removeEventListener("subgraph_compiler_progress", this.onCompileProgress);
+                    this.onCompileProgress = null;
+                }
+                return onRemoved?.apply(this, arguments);
             };
         }
     },